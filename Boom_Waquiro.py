@@ -3,21 +3,53 @@ import pygame
 import pygame.midi
 import random
 import sys
+import bisect
+import heapq
+import threading
+import time
+import collections
+import concurrent.futures
+import csv
+import json
+import sqlite3
 import os
 
 from xml.etree import ElementTree
 
 import argparse
 import subprocess
+import hashlib
+import pickle
+import zipfile
+
+import numpy as np
 
 baseDir = os.getcwd()
 parser = argparse.ArgumentParser(description='Import a musicxml song for a waterfall')
-parser.add_argument('--music', dest='music', help='file path, .musicxml')
+parser.add_argument('--music', dest='music', help='file path, .musicxml or .mxl, to play straight away without the song list')
 parser.add_argument('--folder', dest='folder', default = baseDir, help='folder containing music')
-parser.add_argument('--voice', dest='voices', help='comma separated list of voices to display')
-parser.add_argument('--accompany', dest='accompanyParts', help='comma separted list of parts to use for midi accompaniment')
+parser.add_argument('--voice', dest='voices', help='with --music, comma separated part IDs or names to display, default the first part')
+parser.add_argument('--accompany', dest='accompanyParts', help='with --music, comma separated part IDs or names for midi accompaniment, default all')
 parser.add_argument('--octaves', dest='octaves', default='1', help='number of octaves to show')
-args = parser.parse_args()
+parser.add_argument('--latency', dest='latency', type=int, default=10, help='MIDI output latency in ms, 0 sends each event immediately')
+parser.add_argument('--lookahead', dest='lookahead', type=int, default=40, help='how far ahead accompaniment events are sent to MIDI, in ms')
+parser.add_argument('--synth', dest='synth', choices=['auto', 'midi', 'soft'], default='auto', help='play the accompaniment on a MIDI device or the built in synthesizer, auto uses MIDI when there is a device')
+parser.add_argument('--fps', dest='fps', type=int, default=0, help='target frame rate while playing, default the display refresh rate when it can be found, otherwise 60')
+parser.add_argument('--vsync', dest='vsync', action='store_true', help='show each frame on a display refresh, where supported')
+parser.add_argument('--measure', dest='startMeasure', help='start playing at this measure number')
+parser.add_argument('--loop', dest='loop', help='repeat a range of measures while playing, such as 12-16')
+parser.add_argument('--dirty-rects', dest='dirtyRects', action='store_true', help='only update the parts of the display that changed')
+parser.add_argument('--profile', dest='profile', action='store_true', help='show the frame timing overlay, also toggled with F3')
+parser.add_argument('--startup-times', dest='startupTimes', action='store_true', help='print how long each step of starting up takes')
+parser.add_argument('--trace', dest='trace', help='write frame timings to this .csv or .json file on exit')
+parser.add_argument('--library', dest='library', help='song library index file, default library.sqlite in the cache folder')
+parser.add_argument('--cache', dest='cacheDir', default=os.path.join(os.path.expanduser('~'), '.cache', 'BoomWaquiro'), help='folder for the compiled score cache')
+parser.add_argument('--cache-size', dest='cacheSize', type=int, default=64, help='maximum size of the score cache in MB')
+parser.add_argument('--no-cache', dest='noCache', action='store_true', help='always parse the musicxml file')
+parser.add_argument('--precompile', dest='precompile', help='compile every score under this folder into the cache and library, then exit')
+parser.add_argument('--jobs', dest='jobs', type=int, default=0, help='worker processes for --precompile, default one per core')
+# Defaults until main() reads the command line, so the module can also be imported.
+args = parser.parse_args([])
 
 PI = 3.14159265358
 debugScore = True
@@ -25,23 +57,23 @@ debugScore = True
 """
  Colors needing to be defined.
 """
-BLACK = [0, 0, 0]
-WHITE = [255, 255, 255]
-
-RED = [255, 0, 40]
-REDORANGE = [255, 95, 0]
-ORANGE = [255, 165, 0]
-ORANGEYELLOW = [255, 215, 0]
-YELLOW = [255, 255, 0]
-LIGHTGREEN = [144, 245, 0]
-GREEN = [18, 173, 42]
-DARKGREEN = [40, 160, 120]
-BLUE = [0, 0, 255]
-VIOLET = [48, 16, 180]
-LAVENDER = [129, 0, 127]
-PINK = [210, 15, 192]
-
-GRAY = [200, 200, 200]
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+RED = (255, 0, 40)
+REDORANGE = (255, 95, 0)
+ORANGE = (255, 165, 0)
+ORANGEYELLOW = (255, 215, 0)
+YELLOW = (255, 255, 0)
+LIGHTGREEN = (144, 245, 0)
+GREEN = (18, 173, 42)
+DARKGREEN = (40, 160, 120)
+BLUE = (0, 0, 255)
+VIOLET = (48, 16, 180)
+LAVENDER = (129, 0, 127)
+PINK = (210, 15, 192)
+
+GRAY = (200, 200, 200)
 
 color_list = [
     RED,
@@ -68,8 +100,10 @@ toneLookup = {
     "B" : 11
     }
 
-def drawText(textStr, pos, textSize, color, shadowColor = None, centerX = False, centerY = False):
-    
+def drawText(textStr, pos, textSize, color, shadowColor = None, centerX = False, centerY = False, surface = None):
+    if surface is None:
+        surface = screen
+
     text = create_text(textStr, nameFonts, textSize, color)
     position = pos
     if centerX:
@@ -78,20 +112,20 @@ def drawText(textStr, pos, textSize, color, shadowColor = None, centerX = False,
         position = (position[0], position[1] - text.get_height() // 2)
     if shadowColor is not None:
         textShadow = create_text(textStr, nameFonts, textSize, shadowColor)
-        screen.blit(textShadow,
+        surface.blit(textShadow,
             (position[0] - 1, position[1] - 1))
-        screen.blit(textShadow,
+        surface.blit(textShadow,
             (position[0] + 1, position[1] - 1))
-        screen.blit(textShadow,
+        surface.blit(textShadow,
             (position[0] - 1, position[1]))
-        screen.blit(textShadow,
+        surface.blit(textShadow,
             (position[0] + 1, position[1]))
-        screen.blit(textShadow,
+        surface.blit(textShadow,
             (position[0] - 1, position[1] + 1))
-        screen.blit(textShadow,
+        surface.blit(textShadow,
             (position[0] + 1, position[1] + 1))
         
-    screen.blit(text,
+    surface.blit(text,
         (position[0], position[1]))
 
 
@@ -209,17 +243,142 @@ class Song():
         # Array of Note elements
         self.accompaniment = accompanyNotes
 
+class CompiledScore():
+    # The notes of a musicxml file, walked once and shared by every screen.
+    def __init__(self):
+        self.title = "Untitled"
+        # The first tempo mark, or None when the score gives no tempo
+        self.startTempo = None
+        # Array of [partID, partName]
+        self.parts = []
+        # Dictionary of partID -> array of (onset, duration, tone, adjust, octave, symbol)
+        # Onset and duration are measured in beats.
+        self.notes = dict()
+        # Array of (onset, bpm) from the <sound tempo> directions
+        self.tempoMarks = []
+        # Array of (onset, measure number) for the measures of the first part
+        self.measures = []
+
+class TempoMap():
+    # Converts between beats and seconds following the tempo marks of a score.
+    # Each tempo segment keeps its starting beat and second, so a conversion
+    # is a bisection plus one multiplication.
+    def __init__(self, tempoMarks, startTempo):
+        self.beats = [0.0]
+        self.seconds = [0.0]
+        self.secondsPerBeat = [60 / startTempo]
+        # The marks are sorted by onset.
+        for onset, bpm in tempoMarks:
+            if onset <= self.beats[-1]:
+                # A later mark at the same beat replaces the earlier one.
+                self.secondsPerBeat[-1] = 60 / bpm
+            else:
+                self.seconds.append(self.secondsAt(onset))
+                self.beats.append(onset)
+                self.secondsPerBeat.append(60 / bpm)
+
+    def secondsAt(self, beat):
+        i = max(bisect.bisect_right(self.beats, beat) - 1, 0)
+        return self.seconds[i] + (beat - self.beats[i]) * self.secondsPerBeat[i]
+
+    def secondsAtArray(self, beats):
+        # secondsAt for a NumPy array of beats
+        i = np.maximum(np.searchsorted(self.beats, beats, "right") - 1, 0)
+        return np.array(self.seconds)[i] + (beats - np.array(self.beats)[i]) * np.array(self.secondsPerBeat)[i]
+
+    def beatAt(self, seconds):
+        i = max(bisect.bisect_right(self.seconds, seconds) - 1, 0)
+        return self.beats[i] + (seconds - self.seconds[i]) / self.secondsPerBeat[i]
+
+    def bpmAt(self, seconds):
+        i = max(bisect.bisect_right(self.seconds, seconds) - 1, 0)
+        return 60 / self.secondsPerBeat[i]
+
+# The player keeps its notes in NumPy structured arrays. Times are in seconds,
+# pitch is 12*octave + tone, part indexes the score's parts and symbol indexes
+# NOTE_SYMBOLS.
+NOTE_DTYPE = np.dtype([
+    ("onset", np.float64),
+    ("duration", np.float64),
+    ("pitch", np.int16),
+    ("adjust", np.int8),
+    ("part", np.int16),
+    ("symbol", np.uint8),
+    ])
+# The musicxml note types, with 0 for any other
+NOTE_SYMBOLS = (None, "maxima", "long", "breve", "whole", "half", "quarter", "eighth",
+    "16th", "32nd", "64th", "128th", "256th", "512th", "1024th")
+symbolCodes = {symbol: code for code, symbol in enumerate(NOTE_SYMBOLS)}
+
+def compileNotes(score, tempoMap):
+    # All the notes of a score in one NOTE_DTYPE array, in score order
+    table = np.empty(sum(len(noteTable) for noteTable in score.notes.values()), NOTE_DTYPE)
+    partIndex = {partID: i for i, (partID, partName) in enumerate(score.parts)}
+    start = 0
+    for partID, noteTable in score.notes.items():
+        if len(noteTable) == 0:
+            continue
+        onset, duration, tone, adjust, octave, symbol = zip(*noteTable)
+        onset = np.array(onset, np.float64)
+        rows = table[start:start + len(noteTable)]
+        rows["onset"] = tempoMap.secondsAtArray(onset)
+        rows["duration"] = tempoMap.secondsAtArray(onset + np.array(duration, np.float64)) - rows["onset"]
+        rows["pitch"] = 12*np.array(octave) + np.array(tone)
+        rows["adjust"] = adjust
+        # Parts missing from the part list are numbered after it.
+        rows["part"] = partIndex.setdefault(partID, len(partIndex))
+        rows["symbol"] = [symbolCodes.get(name, 0) for name in symbol]
+        start = start + len(noteTable)
+    return table
+
+def sortNotes(table):
+    # In time order, then by tone, then by octave, keeping score order for ties
+    return table[np.lexsort((table["pitch"] // 12, table["pitch"] % 12, table["onset"]))]
+
+def foldPitches(pitches):
+    # foldOctave for an array of pitches
+    over = np.maximum(pitches - HIGHEST_NOTE, 0)
+    under = np.maximum(LOWEST_NOTE - pitches, 0)
+    return pitches - 12*((over + 11) // 12) + 12*((under + 11) // 12)
+
 class AppMode():
     done = False
     doQuit = False
     def handleEvent(this, event):
         if event.type == pygame.QUIT:  # If user clicked close
-            done = True   # Flag that we are done so we exit this loop
-            doQuit = True
+            this.done = True   # Flag that we are done so we exit this loop
+            this.doQuit = True
+    def isAnimating(this):
+        # True when the screen changes without input. Other modes are only
+        # redrawn after an event, and the main loop sleeps until one arrives.
+        return False
     def updateScreen(this):
         pass
     def doUpdate(this):
         this.updateScreen()
+        profiler.mark("screen")
+    def close(this):
+        pass
+    def isShowing(this):
+        # True when this mode drew the frame currently on the display
+        return presentedMode is this
+    def present(this, rects = None):
+        # Show what has been drawn. With --dirty-rects only the given areas are
+        # sent to the display, unless another mode drew the frame before.
+        # Returns the areas drawn over the frame, such as the timing overlay.
+        global presentedMode
+        overlayRects = profiler.drawOverlay()
+        if rects is None or not args.dirtyRects or not this.isShowing():
+            pygame.display.flip()
+        elif len(overlayRects) > 0:
+            pygame.display.update(rects + overlayRects)
+        else:
+            pygame.display.update(rects)
+        presentedMode = this
+        return overlayRects
+
+# The mode whose frame is on the display
+presentedMode = None
 
 class SongSelector(AppMode):
     songList = []
@@ -227,24 +386,85 @@ class SongSelector(AppMode):
     topRow = 0
     visibleRows = 10
     curPath = ""
+    shownState = None
+    # Library details of the songs in this folder, by file name
+    songInfo = dict()
+    libraryVersion = 0
+    sortModes = ["name", "title", "tempo", "length"]
+    sortMode = 0
+    scanner = None
 
     def loadSongList(this, folderPath):
-        this.curPath = folderPath
-        this.songList = []
+        # The library and its scanner know folders by absolute path.
+        this.curPath = os.path.abspath(folderPath)
         this.topRow = 0
         this.songSelect = 0
-        tempList = os.listdir(folderPath)
-        # Find all the folders first, including the up directory
-        this.songList.append(":..:")
-        for f in tempList:
-            if not os.path.isfile(os.path.join(folderPath, f)):
-                this.songList.append(":"+f+":")
-        # Rescan keeping only files with suffix .musicxml
-        for f in tempList:
-            if os.path.isfile(os.path.join(folderPath, f)) and f.endswith('.musicxml'):
-                this.songList.append(f)
+        this.folders = []
+        this.songFiles = []
+        # One pass over the folder. Keep only plain and compressed musicxml files.
+        with os.scandir(folderPath) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    this.folders.append(entry.name)
+                elif entry.name.endswith(SCORE_SUFFIXES):
+                    this.songFiles.append(entry.name)
+        this.folders.sort()
+        this.loadSongInfo()
+
+        # Bring the library up to date in the background.
+        if this.scanner is not None:
+            this.scanner.stop()
+        if library is not None:
+            this.scanner = LibraryScanner(library, this.curPath, this.songFiles)
+            this.scanner.start()
+
+    def loadSongInfo(this):
+        if library is not None:
+            this.songInfo = library.folderSongs(this.curPath)
+        this.libraryVersion = this.libraryVersion + 1
+        this.sortSongList()
+
+    def sortSongList(this):
+        # Folders come first, including the up directory, then the songs in the chosen order.
+        selected = this.songList[this.songSelect] if this.songSelect < len(this.songList) else None
+        sortMode = this.sortModes[this.sortMode]
+        def songKey(name):
+            info = this.songInfo.get(name)
+            if info is None:
+                # Songs not yet scanned go last.
+                return (1, 0, name.lower())
+            if sortMode == "title":
+                return (0, info["title"].lower(), name.lower())
+            elif sortMode == "tempo":
+                return (0, info["startTempo"], name.lower())
+            elif sortMode == "length":
+                return (0, info["duration"], name.lower())
+            return (0, 0, name.lower())
+        this.songList = [":..:"] + [":"+f+":" for f in this.folders] + sorted(this.songFiles, key=songKey)
+        if selected in this.songList:
+            this.songSelect = this.songList.index(selected)
+            if this.songSelect < this.topRow or this.songSelect >= this.topRow + this.visibleRows:
+                this.topRow = max(this.songSelect - this.visibleRows // 2, 0)
+
+    def showStartup(this, startup):
+        controller.stack.append(this)
+        controller.active = startup
+
+    def close(this):
+        if this.scanner is not None:
+            this.scanner.stop()
 
     def updateScreen(this):
+        # Scans that finished while another screen was up were not seen here,
+        # so read the library again on coming back to the list.
+        if not this.isShowing():
+            this.loadSongInfo()
+        # An unchanged list is not redrawn.
+        shownState = (this.curPath, this.songSelect, this.topRow, this.sortMode, this.libraryVersion)
+        if this.isShowing() and shownState == this.shownState:
+            return
+        this.shownState = shownState
+
         # Set the screen background
         screen.fill(BLACK)
 
@@ -256,7 +476,8 @@ class SongSelector(AppMode):
         PANEWIDTH = 600
         paneLeft = (WIDTH - PANEWIDTH) // 2
         paneTop = (HEIGHT - PANEHEIGHT) // 2
-        pygame.draw.rect(screen, WHITE, pygame.Rect(paneLeft, paneTop, PANEWIDTH, PANEHEIGHT))
+        paneRect = pygame.Rect(paneLeft, paneTop, PANEWIDTH, PANEHEIGHT)
+        pygame.draw.rect(screen, WHITE, paneRect)
         for row in range(this.topRow, this.topRow+this.visibleRows):
             if (row == this.songSelect):
                 prefix = "-> "
@@ -265,14 +486,31 @@ class SongSelector(AppMode):
                 prefix = "  "
                 color = BLACK
             if row < len(this.songList):
-                drawText(prefix + this.songList[row], (paneLeft+10, paneTop + (row-this.topRow+0.5)*LINEHEIGHT), LINEHEIGHT, color)
-        pygame.display.flip()
+                rowTop = paneTop + (row-this.topRow+0.5)*LINEHEIGHT
+                info = this.songInfo.get(this.songList[row])
+                if info is None:
+                    drawText(prefix + this.songList[row], (paneLeft+10, rowTop), LINEHEIGHT, color)
+                else:
+                    # Show what the library knows about the song.
+                    drawText(prefix + info["title"], (paneLeft+10, rowTop), LINEHEIGHT, color)
+                    drawText(str(info["startTempo"]) + " bpm", (paneLeft+440, rowTop), LINEHEIGHT, color)
+                    minutes, seconds = divmod(int(info["duration"]), 60)
+                    drawText("%d:%02d" % (minutes, seconds), (paneLeft+530, rowTop), LINEHEIGHT, color)
+
+        # The sort order sits under the list.
+        sortText = "Sorted by " + this.sortModes[this.sortMode] + ", [S] to change"
+        drawText(sortText, (paneLeft+10, paneTop+PANEHEIGHT+4), LINEHEIGHT, GRAY)
+        sortRect = pygame.Rect(paneLeft, paneTop+PANEHEIGHT, PANEWIDTH, LINEHEIGHT+8)
+        this.present([paneRect, sortRect])
 
     def handleEvent(this, event):
         redraw = False
         # Deal with higher level events
         super().handleEvent(event)
-        if event.type == pygame.KEYDOWN:
+        if event.type == LIBRARY_UPDATED and event.folder == this.curPath:
+            redraw = True
+            this.loadSongInfo()
+        elif event.type == pygame.KEYDOWN:
             # Select the current song or folder
             if event.key == pygame.K_RETURN:
                 # See if it is a directory.
@@ -283,12 +521,19 @@ class SongSelector(AppMode):
                     this.loadSongList(pathDir)
                 else:
                     redraw = False
-                    controller.stack.append(this)
-                    controller.active = SongStartup()
-                    controller.active.initialize(this.curPath, this.songList[this.songSelect])
+                    song = this.songList[this.songSelect]
+                    startup = SongStartup()
+                    controller.active = SongLoader()
+                    controller.active.initialize(this, song,
+                        lambda progress: startup.initialize(this.curPath, song, progress),
+                        lambda result: this.showStartup(startup))
 
             elif event.key == pygame.K_ESCAPE:
                 this.done = True
+            elif event.key == pygame.K_s:
+                redraw = True
+                this.sortMode = (this.sortMode + 1) % len(this.sortModes)
+                this.sortSongList()
             elif event.key in [pygame.K_UP, pygame.K_j]:
                 redraw = True
                 this.songSelect = max(this.songSelect - 1, 0)
@@ -303,151 +548,252 @@ class SongSelector(AppMode):
             this.doUpdate()
 
 
+# Posted by a SongLoader worker when it has finished
+LOAD_FINISHED = pygame.USEREVENT + 2
+
+class LoadCancelled(Exception):
+    pass
+
+class SongLoader(AppMode):
+    # Runs a slow loading step on a worker thread and shows its progress.
+    # work is called on the worker with a progress function taking the fraction
+    # done. ready is called with its result back on this thread, and should
+    # make the next mode active. ESC returns to the previous mode, or quits
+    # when there is none.
+    progress = 0.0
+    shownState = None
+
+    def initialize(this, previous, title, work, ready):
+        this.previous = previous
+        this.title = title
+        this.work = work
+        this.ready = ready
+        this.result = None
+        this.error = None
+        this.finished = False
+        this.cancelled = False
+        this.clock = pygame.time.Clock()
+        this.worker = threading.Thread(target=this.run, daemon=True)
+        this.worker.start()
+
+    def run(this):
+        try:
+            this.result = this.work(this.setProgress)
+        except LoadCancelled:
+            pass
+        except Exception as err:
+            this.error = err
+        this.finished = True
+        if pygame.display.get_init():
+            # Wake the main loop. A load started before the display opened has none to wake.
+            pygame.event.post(pygame.event.Event(LOAD_FINISHED))
+
+    def isAnimating(this):
+        return True
+
+    def setProgress(this, fraction):
+        # Called from the worker. Stops the work once the load is cancelled.
+        if this.cancelled:
+            raise LoadCancelled()
+        this.progress = min(fraction, 1.0)
+
+    def updateScreen(this):
+        # Only the bar moves, and only in steps of a pixel.
+        PANEWIDTH = 600
+        shownState = int(this.progress * PANEWIDTH)
+        if this.isShowing() and shownState == this.shownState:
+            return
+        this.shownState = shownState
+
+        screen.fill(BLACK)
+        WIDTH = screen.get_width()
+        HEIGHT = screen.get_height()
+        LINEHEIGHT = 18
+        paneLeft = (WIDTH - PANEWIDTH) // 2
+        paneTop = (HEIGHT - 3*LINEHEIGHT) // 2
+        drawText("Loading " + str(this.title), (paneLeft, paneTop), LINEHEIGHT, WHITE)
+        pygame.draw.rect(screen, GRAY, pygame.Rect(paneLeft, paneTop + 2*LINEHEIGHT, PANEWIDTH, LINEHEIGHT), 1)
+        pygame.draw.rect(screen, WHITE, pygame.Rect(paneLeft, paneTop + 2*LINEHEIGHT, shownState, LINEHEIGHT))
+        drawText("[Esc] to cancel", (paneLeft, paneTop + 4*LINEHEIGHT), LINEHEIGHT, GRAY)
+        this.present()
+
+    def doUpdate(this):
+        if this.finished:
+            if this.error is not None:
+                print("Unable to load", this.title, this.error)
+                this.leave()
+            else:
+                this.ready(this.result)
+            return
+        super().doUpdate()
+        this.clock.tick(30)
+
+    def handleEvent(this, event):
+        super().handleEvent(event)
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
+            # The worker stops at its next progress report and its result is dropped.
+            this.cancelled = True
+            this.leave()
+
+    def leave(this):
+        if this.previous is None:
+            this.done = True
+        else:
+            controller.active = this.previous
+
+# Posted by a LibraryScanner when it has stored new song details for a folder
+LIBRARY_UPDATED = pygame.USEREVENT + 1
+# Least time between LIBRARY_UPDATED events from one scan, in seconds
+LIBRARY_UPDATE_INTERVAL = 0.5
+
+class SongLibrary():
+    # An SQLite index of song details, so a folder can be listed and sorted
+    # without parsing its songs. Each thread opens its own connection.
+    def __init__(self, path):
+        self.path = path
+        self.connection = self.connect()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY KEY, folder TEXT, size INTEGER, mtime INTEGER, "
+            "title TEXT, parts TEXT, startTempo INTEGER, duration REAL, notes INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS songsByFolder ON songs (folder)")
+        self.connection.commit()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        # Readers are not blocked while a scanner writes.
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def storeSong(self, connection, path, size, mtime, info):
+        # Index a song from its absolute path, file stamp and describeScore details.
+        connection.execute("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, os.path.dirname(path), size, mtime, info["title"], json.dumps(info["parts"]),
+             info["startTempo"], info["duration"], info["notes"]))
+
+    def folderSongs(self, folder):
+        # Details of the indexed songs in folder, by file name
+        songs = dict()
+        rows = self.connection.execute("SELECT path, title, parts, startTempo, duration, notes FROM songs WHERE folder = ?", (os.path.abspath(folder),))
+        for path, title, parts, startTempo, duration, notes in rows:
+            songs[os.path.basename(path)] = {"title": title, "parts": json.loads(parts), "startTempo": startTempo, "duration": duration, "notes": notes}
+        return songs
+
+class LibraryScanner(threading.Thread):
+    # Indexes the songs of one folder in the background, skipping those whose
+    # size and modification time are unchanged since they were last indexed.
+    def __init__(self, library, folder, songFiles):
+        super().__init__(daemon=True)
+        self.library = library
+        self.folder = os.path.abspath(folder)
+        self.songFiles = list(songFiles)
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        connection = self.library.connect()
+        try:
+            self.scan(connection)
+        finally:
+            connection.close()
+
+    def scan(self, connection):
+        known = dict()
+        for path, size, mtime in connection.execute("SELECT path, size, mtime FROM songs WHERE folder = ?", (self.folder,)):
+            known[path] = (size, mtime)
+
+        lastPost = time.perf_counter()
+        changed = False
+        for name in self.songFiles:
+            if self.stopped:
+                break
+            path = os.path.join(self.folder, name)
+            try:
+                fileStat = os.stat(path)
+                if known.pop(path, None) == (fileStat.st_size, fileStat.st_mtime_ns):
+                    continue
+                score = scoreCache.load(path)
+                self.library.storeSong(connection, path, fileStat.st_size, fileStat.st_mtime_ns, describeScore(score))
+                connection.commit()
+            except Exception as err:
+                # One bad file should not stop the scan.
+                print("Unable to index", path, err)
+                continue
+            changed = True
+            if time.perf_counter() - lastPost > LIBRARY_UPDATE_INTERVAL:
+                pygame.event.post(pygame.event.Event(LIBRARY_UPDATED, folder=self.folder))
+                lastPost = time.perf_counter()
+                changed = False
+
+        if not self.stopped:
+            # Forget songs that are no longer in the folder.
+            for path in known:
+                connection.execute("DELETE FROM songs WHERE path = ?", (path,))
+                changed = True
+            connection.commit()
+            if changed:
+                pygame.event.post(pygame.event.Event(LIBRARY_UPDATED, folder=self.folder))
+
+def describeScore(score):
+    # The details of a compiled score kept in the song library
+    startTempo = score.startTempo if score.startTempo is not None else SongStartup.tempo
+    endBeat = 0
+    notes = 0
+    for noteTable in score.notes.values():
+        notes = notes + len(noteTable)
+        for onset, duration, tone, adjust, octave, symbol in noteTable:
+            endBeat = max(endBeat, onset + duration)
+    return {
+        "title": score.title if score.title is not None else "Untitled",
+        "parts": [partName for partID, partName in score.parts],
+        "startTempo": startTempo,
+        "duration": TempoMap(score.tempoMarks, startTempo).secondsAt(endBeat),
+        "notes": notes,
+    }
+
 class SongStartup(AppMode):
     topRow = 0
     curRow = 0
     visibleRows = 6
     tempo = 80
     octaves = 2
+    shownState = None
 
-    def initialize(this, path, song):
+    def initialize(this, path, song, progress=None):
         songPath = os.path.join(path, song)
         this.players = []
         this.accompany = []
-        this.playNotes = []
-        startTempo = 0
 
         # Import the music data
-        this.mxml = ElementTree.parse(songPath).getroot()
-
-        # Find the title
-        titleTypes = ["work/work-title", "movement-title"]
-        this.songTitle = "Untitled"
-        for titleType in titleTypes:
-            workTitle = this.mxml.find(titleType)
-            print(titleType, workTitle)
-            if workTitle is not None:
-                this.songTitle = workTitle.text
-                break
-            
-        if (this.mxml.tag == 'score-partwise'):
-            # This structure has multiple parts. Each part has multiple measures.
-            # Find the list of parts.
-            partlist = this.mxml.find("part-list")
-            this.parts = []
-            if partlist is not None:
-                # Find the part we are looking for.
-                for part in partlist.iter("score-part"):
-                    partID = part.get("id")
-                    partName = part.find("part-name")
-                    print(partID, partName.text)
-                    this.parts.append([partID, "" if partName is None or partName.text is None else partName.text])
-            for part in this.mxml.iter("part"):
-                # Work through each measure in the part.
-                timeCode = 0.0
-                partCode = part.get("id")
-                for measure in part.iter("measure"):
-                    # Within each measure, go through each element.
-                    # Some elements are about attributes.
-                    # Others are notes, rests or other timing items.
-                    for musicUnit in measure:
-                        if musicUnit.tag == "direction":
-                            # Tempo is hidden in direction including "sound"
-                            soundFeature = musicUnit.find("sound")
-                            if soundFeature is not None and soundFeature.get("tempo") is not None:
-                                tempo = int(soundFeature.get("tempo"))
-                                if startTempo == 0:
-                                    startTempo = tempo
-                                    this.tempo = tempo
+        this.score = scoreCache.load(songPath, progress)
+        this.songTitle = this.score.title
+        this.parts = this.score.parts
+        if this.score.startTempo is not None:
+            this.tempo = this.score.startTempo
         this.updatePlayerParts()
 
     def updatePlayerParts(this):
-        this.playNotes = []
         this.noteCount = dict()
-        if (this.mxml.tag == 'score-partwise'):
-            # Using the parts identified, look for measures belonging to that part.
-            for part in this.mxml.iter("part"):
-                # Work through each measure in the part.
-                timeCode = 0.0
-                partCode = part.get("id")
-                for measure in part.iter("measure"):
-                    # Within each measure, go through each element.
-                    # Some elements are about attributes.
-                    # Others are notes, rests or other timing items.
-                    for musicUnit in measure:
-                        if musicUnit.tag == "note":
-                            tieInfo = musicUnit.find("tie")
-                            if tieInfo is not None:
-                                typeOfTie = tieInfo.get("type")
-                            else:
-                                typeOfTie = "none"
-
-                            # If it is not a rest, then pull out the pitch information.
-                            if musicUnit.find("rest") is None and (tieInfo is None or typeOfTie == "start"):
-                                # What note is played by pitch?
-                                pitchInfo = musicUnit.find("pitch")
-                                octave = pitchInfo.find("octave")
-                                step = pitchInfo.find("step")
-                                alter = pitchInfo.find("alter")
-                                # What type of note?
-                                symbol = musicUnit.find("type").text
-
-                                # Translate to standard information
-                                tone = toneLookup.get(step.text)
-                                adjust = 0
-                                if alter is not None:
-                                    adjust = int(alter.text)
-                                    tone = tone + adjust
-                                if octave is None:
-                                    octave = 4
-                                else:
-                                    octave = int(octave.text)
-
-                                # Standardize in case sharps or flats shift to different octave
-                                noteIndex = 12*octave+tone
-                                octave = noteIndex // 12
-                                tone = noteIndex % 12
-
-                                if partCode in this.players:
-                                    adjustedTone = 12*octave + tone
-                                    while adjustedTone > HIGHEST_NOTE:
-                                        octave = octave - 1
-                                        adjustedTone = 12*octave + tone
-                                    while adjustedTone < LOWEST_NOTE:
-                                        octave = octave + 1
-                                        adjustedTone = 12*octave + tone
-                                    theNote = Note(tone, adjust, octave, symbol, timeCode, 1)
-                                    this.playNotes.append(theNote)
-                                    newCnt = this.noteCount.get(adjustedTone, 0) + 1
-                                    this.noteCount[adjustedTone] = newCnt
-
-        elif (this.mxml.tag == 'score-timewise'):
-            # This structure has multiple measures. Each measure has multiple parts.
-            pass
-        else:
-            print("Score structure not recognized.")
-
-        # Sort the notes into time-based ordering.
-        this.playNotes.sort(key = lambda note : note.octave)
-        this.playNotes.sort(key = lambda note : note.tone)
+        for partID in this.players:
+            for onset, duration, tone, adjust, octave, symbol in this.score.notes.get(partID, []):
+                adjustedTone = 12*foldOctave(tone, octave) + tone
+                newCnt = this.noteCount.get(adjustedTone, 0) + 1
+                this.noteCount[adjustedTone] = newCnt
 
     def updateScreen(this):
-        # Set the screen background
-        screen.fill(WHITE)
+        # An unchanged screen is not redrawn.
+        shownState = (this.tempo, this.curRow, this.topRow, tuple(this.players), tuple(this.accompany))
+        if this.isShowing() and shownState == this.shownState:
+            return
+        this.shownState = shownState
+
+        # Set the screen background with the title, BPM and play line
+        drawBackground(this.songTitle, this.tempo)
 
         # Clear the window space for the list
         WIDTH = screen.get_width()
         HEIGHT = screen.get_height()
 
-        # Draw the title of the song
-        drawText(this.songTitle, (WIDTH // 2, HEIGHT // 4), 36, GRAY, centerX= True)
-
-        # Draw BPM
-        drawText(str(this.tempo) + " bpm", (WIDTH // 2, HEIGHT // 4 + 36), 24, GRAY, centerX= True)
-
-        # Draw the line where we should play.
-        pygame.draw.line(screen, BLACK, [0,FLASHLINE], [WIDTH,FLASHLINE], 5)
-
         # Process each note that should appear on the screen.
         if this.octaves=='1':
             refPos = 100
@@ -461,13 +807,9 @@ class SongStartup(AppMode):
             octave = note // 12
             tone = note % 12
             x = refPos + (note-48)*spacing
-            noteName = diatonicNames[tone] + str(octave)
-            theNote = Note(tone, 0, octave, "Q", 0, 1)
-            theNote.draw(screen, (x, STARTLINE), 0)
+            drawNoteSprite(screen, tone, 0, "", (x, STARTLINE))
 
             cnt = this.noteCount[note]
-            pos = (x, STARTLINE+20)
-
             drawText(str(cnt), (x, STARTLINE + 20), 18, WHITE, BLACK, True, True)
 
         LINEHEIGHT = 18
@@ -493,7 +835,7 @@ class SongStartup(AppMode):
                 playCode = playCode + ("A]" if partID in this.accompany else " ]")
                 drawText(prefix + playCode, (paneLeft+10, paneTop + (row-this.topRow+2)*LINEHEIGHT), LINEHEIGHT, color)
                 drawText(" ".join(this.parts[row]), (paneLeft+80, paneTop + (row-this.topRow+2)*LINEHEIGHT), LINEHEIGHT, color)
-        pygame.display.flip()
+        this.present()
 
     def handleEvent(this, event):
         redraw = False
@@ -503,8 +845,11 @@ class SongStartup(AppMode):
             # Play the current song or folder
             if event.key == pygame.K_RETURN:
                 redraw = False
-                controller.active = SongPlayer()
-                controller.active.initialize(this.mxml, this.players, this.accompany, this.octaves, this.songTitle, this.tempo)
+                player = SongPlayer()
+                controller.active = SongLoader()
+                controller.active.initialize(this, this.songTitle,
+                    lambda progress: player.compile(this.score, this.players, this.accompany if len(this.accompany) > 0 else None, this.octaves, this.songTitle, this.tempo, progress),
+                    lambda result: this.showPlayer(player))
 
             # Backup a level and choose a different song
             elif event.key == pygame.K_ESCAPE:
@@ -547,246 +892,285 @@ class SongStartup(AppMode):
         if redraw:
             this.doUpdate()
 
+    def showPlayer(this, player):
+        player.start()
+        controller.active = player
+
 
 class SongPlayer(AppMode):
-    def initialize(this, mxml, players, accompany, octaves, title, bpm):
+    shownBackground = None
+
+    def initialize(this, score, players, accompany, octaves, title, bpm):
+        this.compile(score, players, accompany, octaves, title, bpm)
+        this.start()
+
+    def compile(this, score, players, accompany, octaves, title, bpm, progress=None):
+        # Everything that does not touch the display or MIDI, so it can run
+        # on a loading thread.
         this.playerParts = players
         this.accompanyParts = accompany
-        this.playNotes = []
-        this.accompaniment = []
         this.octaves = octaves
         this.songTitle = title
+        # Song time follows the tempo marks of the score. The tempo picked with
+        # +/- scales the whole song through timeFactor, relative to startTempo.
         this.tempo = bpm
-        tempo = bpm
-
-        this.noteQueue = []
-        this.lastNoteTimeCode = 0
-
-        this.beatDivisions = 1
-        if (mxml.tag == 'score-partwise'):
-            # Using the parts identified, look for measures belonging to that part.
-            for part in mxml.iter("part"):
-                # Work through each measure in the part.
-                timeCode = 0.0
-                partCode = part.get("id")
-                for measure in part.iter("measure"):
-                    # Within each measure, go through each element.
-                    # Some elements are about attributes.
-                    # Others are notes, rests or other timing items.
-                    for musicUnit in measure:
-                        if musicUnit.tag == "attributes":
-                            # Additional timing info is in the time signature.
-                            divisions = musicUnit.find("divisions")
-                            if divisions is not None:
-                                beatDivisions = int(divisions.text)
-
-                            timeSig = musicUnit.find("time")
-                            if timeSig is not None:
-                                beats = timeSig.find("beats")
-                                count = int(beats.text)
-                                beatType = timeSig.find("beat-type")
-                                countType = int(beatType.text)
-                        elif musicUnit.tag == "note":
-                            duration = int(musicUnit.find("duration").text)
-                            timeLength = duration / beatDivisions * 60 / tempo
-                            tieInfo = musicUnit.find("tie")
-                            if tieInfo is not None:
-                                typeOfTie = tieInfo.get("type")
-                            else:
-                                typeOfTie = "none"
-
-                            # If it is not a rest, then pull out the pitch information.
-                            if musicUnit.find("rest") is None and (tieInfo is None or typeOfTie == "start"):
-                                chordInfo = musicUnit.find("chord")
-                                if chordInfo is not None:
-                                    timeCode = lastTime
-                                # What note is played by pitch?
-                                pitchInfo = musicUnit.find("pitch")
-                                octave = pitchInfo.find("octave")
-                                step = pitchInfo.find("step")
-                                alter = pitchInfo.find("alter")
-                                # What type of note?
-                                symbol = musicUnit.find("type").text
-
-                                # Translate to standard information
-                                tone = toneLookup.get(step.text)
-                                adjust = 0
-                                if alter is not None:
-                                    adjust = int(alter.text)
-                                    tone = tone + adjust
-                                if octave is None:
-                                    octave = 4
-                                else:
-                                    octave = int(octave.text)
-
-                                # Standardize in case sharps or flats shift to different octave
-                                noteIndex = 12*octave+tone
-                                octave = noteIndex // 12
-                                tone = noteIndex % 12
-                                # If accompanyParts is empty, all parts are included in the accompaniment.
-                                if len(this.accompanyParts)==0 or partCode in this.accompanyParts:
-                                    theNote = Note(tone, adjust, octave, symbol, timeCode, timeLength)
-                                    this.accompaniment.append(theNote)
-
-                                if partCode in players:
-                                    adjustedTone = 12*octave + tone
-                                    while adjustedTone > HIGHEST_NOTE:
-                                        octave = octave - 1
-                                        adjustedTone = 12*octave + tone
-                                    while adjustedTone < LOWEST_NOTE:
-                                        octave = octave + 1
-                                        adjustedTone = 12*octave + tone
-                                    theNote = Note(tone, adjust, octave, symbol, timeCode, timeLength)
-                                    this.playNotes.append(theNote)
-
-                            lastTime = timeCode
-                            timeCode = timeCode + timeLength
-
-
-                        # Shift time backwards to get additional notes in the measure
-                        elif musicUnit.tag == "backup":
-                            duration = int(musicUnit.find("duration").text)
-                            # Convert to seconds
-                            timeCode = timeCode - duration / beatDivisions * 60 / tempo
-                            lastTime = timeCode
-
-                        # Shift time forwards without rest to get next note in the measure
-                        elif musicUnit.tag == "forward":
-                            duration = int(musicUnit.find("duration").text)
-                            # Convert to seconds
-                            timeCode = timeCode + duration / beatDivisions * 60 / tempo
-                            lastTime = timeCode
-
-        elif (mxml.tag == 'score-timewise'):
-            # This structure has multiple measures. Each measure has multiple parts.
-            pass
+        this.startTempo = score.startTempo if score.startTempo is not None else bpm
+        this.tempoMap = TempoMap(score.tempoMarks, this.startTempo)
+
+        # Convert the compiled note tables from beats to seconds.
+        notes = compileNotes(score, this.tempoMap)
+        if progress is not None:
+            progress(0.5)
+        partIDs = [partID for partID, partName in score.parts]
+        # If accompanyParts is None, all parts are included in the accompaniment.
+        if this.accompanyParts is None:
+            this.accompaniment = sortNotes(notes)
         else:
-            print("Score structure not recognized.")
-
-        # Sort the notes into time-based ordering.
-        this.playNotes.sort(key = lambda note : note.octave)
-        this.playNotes.sort(key = lambda note : note.tone)
-        this.playNotes.sort(key = lambda note : note.timeCode)
-
-        this.accompaniment.sort(key = lambda note : note.octave)
-        this.accompaniment.sort(key = lambda note : note.tone)
-        this.accompaniment.sort(key = lambda note : note.timeCode)
-        this.restartSong()
-
-    def restartSong(this):
-        global paused
-        paused = False
-        this.clock = pygame.time.Clock()
-
-        this.timeCode = -timeOnScreen
-        this.lastNoteTimeCode = this.timeCode
-        firstNote = 0
-        this.startTempo = this.tempo
-        this.timeFactor = 1
-
-    def updateScreen(this):
-        # Set the screen background
-        screen.fill(WHITE)
-
-        # Draw the line where we should play.
-        pygame.draw.line(screen, BLACK, [0,FLASHLINE], [WIDTH,FLASHLINE], 5)
-        
-        # Draw the title of the song
-        drawText(this.songTitle, (WIDTH // 2, HEIGHT // 4), 36, GRAY, centerX= True)
+            this.accompaniment = sortNotes(notes[np.isin(notes["part"], [partIDs.index(p) for p in this.accompanyParts if p in partIDs])])
+        this.playNotes = notes[np.isin(notes["part"], [partIDs.index(p) for p in players if p in partIDs])]
+        this.playNotes["pitch"] = foldPitches(this.playNotes["pitch"])
+        this.playNotes = sortNotes(this.playNotes)
+
+        # Onset times let each frame find its visible window with searchsorted.
+        this.playOnsets = this.playNotes["onset"]
+        # Notes from upcomingHead onward are still waiting at the start line.
+        # The last note of each pitch stands in for all of them there.
+        this.playPitches = this.playNotes["pitch"].tolist()
+        this.playTones = (this.playNotes["pitch"] % 12).tolist()
+        this.playAdjusts = this.playNotes["adjust"].tolist()
+        this.upcomingHead = 0
+        this.upcomingCount = dict()
+        this.lastNoteOfPitch = dict()
+        for i, pitch in enumerate(this.playPitches):
+            this.upcomingCount[pitch] = this.upcomingCount.get(pitch, 0) + 1
+            this.lastNoteOfPitch[pitch] = i
+        # Each pitch's notes, to recount the start line after a seek
+        this.pitchNotes = dict()
+        for i, pitch in enumerate(this.playPitches):
+            this.pitchNotes.setdefault(pitch, []).append(i)
+
+        # The measure index: when each measure starts, and where to find a measure by its number.
+        this.measureNumbers = [number for onset, number in score.measures]
+        this.measureTimes = [this.tempoMap.secondsAt(onset) for onset, number in score.measures]
+        this.measureIndex = dict()
+        for measure, number in enumerate(this.measureNumbers):
+            this.measureIndex.setdefault(number, measure)
+        this.songEnd = max((notes["onset"] + notes["duration"]).tolist() + this.measureTimes + [0])
+        # The measure sought to, until it reaches the play line
+        this.pendingMeasure = None
+        # First and last measures of the A-B loop, or None
+        this.loopStart = None
+        this.loopEnd = None
+        # Digits typed for a measure to go to
+        this.measureEntry = ""
+
+        # Start line labels, so counting down does not build new strings
+        this.countLabels = [str(count) for count in range(max(this.upcomingCount.values(), default=0) + 1)]
+
+    def start(this):
+        # The accompaniment plays on its own thread against the song clock.
+        this.songClock = SongClock()
+        if midiDevice is not None:
+            this.accompanyThread = AccompanimentThread(this.accompaniment, this.songClock, midiDevice, args.latency, args.lookahead)
+        else:
+            this.accompanyThread = SynthThread(this.accompaniment, this.songClock)
 
-        # Draw BPM
-        drawText(str(this.tempo) + " bpm", (WIDTH // 2, HEIGHT // 4 + 36), 24, GRAY, centerX= True)
+        # Draw each kind of falling note once up front.
+        for tone, adjust in set(zip(this.playTones, this.playAdjusts)):
+            create_note_sprite(tone, adjust)
 
-        # Process each note that should appear on the screen.
-        i = 0
-        drawQueue = []
-        noteQueue = set()
-        lastNote = dict()
-        
+        # Where each note falls across the screen
         if this.octaves=='1':
             refPos = 100
             spacing = (WIDTH-200) // 12
         else:
             refPos = WIDTH//2
             spacing = (WIDTH-200) // 24
-        while i < len(this.playNotes):
-            nextNote = this.playNotes[i]
-            octave = nextNote.octave
-            tone = nextNote.tone
-            x = refPos + ((octave-4)*12 + tone)*spacing
-            noteName = diatonicNames[tone] + str(octave)
-
-            if this.timeCode < nextNote.timeCode and nextNote.timeCode < this.timeCode + timeOnScreen/this.timeFactor:
-                # Draw the note
-                y = STARTLINE + int((FLASHLINE-STARTLINE)*(1 + (this.timeCode - nextNote.timeCode)*this.timeFactor/timeOnScreen))
-                addNote = DrawNote(nextNote, x, y, this.timeCode)
-                addNote.note.index = ""
-                drawQueue.append(addNote)
-            elif nextNote.timeCode >= this.timeCode + timeOnScreen/this.timeFactor:
-                # Draw the note on the start line
-                addNote = DrawNote(nextNote, x, STARTLINE, this.timeCode)
-                if lastNote.get(noteName) is None:
-                    lastNote[noteName] = 1
-                else:
-                    lastNote[noteName] = lastNote.get(noteName) + 1
-                addNote.note.index = str(lastNote[noteName])
-                drawQueue.append(addNote)
-
-
-            i = i+1
-        
-        def noteSort(drawNote):
-            return drawNote.note.octave * 12 + drawNote.note.tone
-
-        drawQueue.sort(key=noteSort)
-
-        for note in drawQueue:
-            drawDashedHLine(screen, note.y, 10, 20)
-        for drawNote in drawQueue:
-            drawNote.note.draw(screen, [drawNote.x, drawNote.y], drawNote.time)
+        this.playX = (refPos + (this.playNotes["pitch"].astype(int) - 48)*spacing).tolist()
+
+        # Buffers reused by every frame. The y buffers grow to the busiest window.
+        this.yBuffer = np.empty(64)
+        this.yLines = np.empty(64, int)
+        # Screen areas drawn over the background on the last frame, and the
+        # list being filled for this one
+        this.dirtyRects = []
+        this.drawnRects = []
+        this.pacer = FramePacer(args.fps if args.fps > 0 else refreshRate, vsync, refreshRate)
+        this.restartSong()
+        this.accompanyThread.start()
 
-        # Go ahead and update the screen with what we've drawn.
-        pygame.display.flip()
-    
-    def updateNoteQueue(this):
-        global debugScore
+        # Practice settings from the command line
+        if args.loop is not None:
+            first, sep, last = args.loop.partition("-")
+            if first in this.measureIndex and (last or first) in this.measureIndex:
+                this.setLoop(this.measureIndex[first], this.measureIndex[last or first])
+            else:
+                print("No measures", args.loop, "to loop")
+        if args.startMeasure is not None:
+            if args.startMeasure in this.measureIndex:
+                this.seekMeasure(this.measureIndex[args.startMeasure])
+            else:
+                print("No measure", args.startMeasure)
+        elif this.loopStart is not None:
+            this.seekMeasure(this.loopStart)
 
-        # Find all notes that should have turned off.
-        offQueue = []
-        for note in this.noteQueue:
-            time = note.timeCode + note.timeLength
-            if time > this.lastNoteTimeCode and time <= this.timeCode:
-                offQueue.append(note)
+    def restartSong(this):
+        global paused
+        paused = False
+        this.pendingMeasure = None
 
-        for note in offQueue:
-            pitch = 12 + 12*note.octave + note.tone
-            midiDevice.note_off(pitch)
-            this.noteQueue.remove(note)
+        this.timeFactor = this.startTempo / this.tempo
+        this.accompanyThread.setTimeFactor(this.timeFactor)
+        this.accompanyThread.seek(-timeOnScreen)
+        this.accompanyThread.resume()
+        this.timeCode = this.songClock.now()
 
-        # Turn on new notes
-        newNote = False
-        for note in this.accompaniment:
-            if note.timeCode > this.lastNoteTimeCode and note.timeCode <= this.timeCode:
-                newNote = True
-                if debugScore:
-                    print(diatonicNames[note.tone], note.octave, sep='', end=' ')
-                pitch = 12 + 12*note.octave + note.tone
-                midiDevice.note_on(pitch, 100)
-                this.noteQueue.append(note)
-        if newNote and debugScore:
-            print()
-        this.lastNoteTimeCode = this.timeCode
+    def updateScreen(this):
+        # Set the screen background with the title, BPM and play line.
+        # In dirty rectangle mode only the areas drawn on last frame are restored,
+        # unless the background itself has changed.
+        background = create_background(this.songTitle, this.currentTempo(), this.statusText())
+        fullFrame = not args.dirtyRects or not this.isShowing() or background is not this.shownBackground
+        if fullFrame:
+            screen.blit(background, (0, 0))
+        else:
+            for rect in this.dirtyRects:
+                screen.blit(background, rect, rect)
+        this.shownBackground = background
+
+        # Find the notes that should appear on the screen.
+        windowEnd = this.timeCode + timeOnScreen/this.timeFactor
+        first = int(np.searchsorted(this.playOnsets, this.timeCode, "right"))
+        head = int(np.searchsorted(this.playOnsets[first:], windowEnd, "left")) + first
+        this.moveUpcomingHead(head)
+
+        # The heights of the falling notes, worked out in place in the y buffers
+        count = head - first
+        if count > len(this.yBuffer):
+            this.yBuffer = np.empty(2*count)
+            this.yLines = np.empty(2*count, int)
+        ys = this.yBuffer[:count]
+        np.subtract(this.timeCode, this.playOnsets[first:head], out=ys)
+        ys *= this.timeFactor
+        ys /= timeOnScreen
+        ys += 1
+        ys *= FLASHLINE-STARTLINE
+        yLines = this.yLines[:count]
+        np.copyto(yLines, ys, casting="unsafe")
+        yLines += STARTLINE
+        yList = yLines.tolist()
+
+        drawnRects = this.drawnRects
+        drawnRects.clear()
+        for y in yList:
+            drawnRects.append(drawDashedHLine(screen, y, 10, 20))
+        if head < len(this.playPitches):
+            drawnRects.append(drawDashedHLine(screen, STARTLINE, 10, 20))
+        for i in range(count):
+            note = first + i
+            drawnRects.append(drawNoteSprite(screen, this.playTones[note], this.playAdjusts[note], "", (this.playX[note], yList[i])))
+
+        # Draw the notes still to come on the start line, labeled with how many remain
+        for pitch, remaining in this.upcomingCount.items():
+            if remaining > 0:
+                note = this.lastNoteOfPitch[pitch]
+                drawnRects.append(drawNoteSprite(screen, this.playTones[note], this.playAdjusts[note], this.countLabels[remaining], (this.playX[note], STARTLINE)))
+                count = count + 1
+
+        profiler.count("notes", count)
+        this.pacer.frameDrawn()
+
+        # Go ahead and update the screen with what we've drawn. Last frame's
+        # list is done with once it has been sent, so the two lists swap.
+        if fullFrame:
+            drawnRects.extend(this.present())
+        else:
+            updateRects = this.dirtyRects
+            updateRects.extend(drawnRects)
+            drawnRects.extend(this.present(updateRects))
+        this.drawnRects = this.dirtyRects
+        this.dirtyRects = drawnRects
+
+    def isAnimating(this):
+        # A paused song waits for input like the menus do.
+        return not paused
+
+    def currentTempo(this):
+        # Beats per minute being played right now, including any +/- change
+        return int(round(this.tempoMap.bpmAt(this.timeCode) / this.timeFactor))
+
+    def statusText(this):
+        # The measure at the play line, the loop and any measure being typed
+        if len(this.measureNumbers) == 0:
+            return ""
+        status = "Bar " + this.measureNumbers[this.currentMeasure()]
+        if this.loopStart is not None:
+            status = status + "   Loop " + this.measureNumbers[this.loopStart] + "-" + this.measureNumbers[this.loopEnd]
+        if this.measureEntry != "":
+            status = status + "   Go to bar " + this.measureEntry
+        return status
+
+    def currentMeasure(this):
+        # The measure at the play line. Just after a seek, the measure sought
+        # to counts as current until it gets there.
+        if this.pendingMeasure is not None and this.timeCode < this.measureTimes[this.pendingMeasure]:
+            return this.pendingMeasure
+        return max(bisect.bisect_right(this.measureTimes, this.timeCode) - 1, 0)
+
+    def seekMeasure(this, measure):
+        # Play from the start of a measure. Its notes start at the top of the
+        # screen, so there is the usual time to get ready.
+        if len(this.measureTimes) == 0:
+            return
+        measure = min(max(measure, 0), len(this.measureTimes) - 1)
+        this.pendingMeasure = measure
+        this.timeCode = this.measureTimes[measure] - timeOnScreen/this.timeFactor
+        this.accompanyThread.seek(this.timeCode)
+
+    def setLoop(this, first, last):
+        this.loopStart = min(first, last)
+        this.loopEnd = max(first, last)
+
+    def loopEndTime(this):
+        if this.loopEnd + 1 < len(this.measureTimes):
+            return this.measureTimes[this.loopEnd + 1]
+        return this.songEnd
+
+    def moveUpcomingHead(this, head):
+        # Adjust the per-pitch counts of upcoming notes as the window moves.
+        # Restarts and tempo changes can move the window backwards.
+        if abs(head - this.upcomingHead) > len(this.pitchNotes):
+            # After a seek it is quicker to count each pitch again by bisection.
+            for pitch, notes in this.pitchNotes.items():
+                this.upcomingCount[pitch] = len(notes) - bisect.bisect_left(notes, head)
+            this.upcomingHead = head
+            return
+        while this.upcomingHead < head:
+            this.upcomingCount[this.playPitches[this.upcomingHead]] -= 1
+            this.upcomingHead = this.upcomingHead + 1
+        while this.upcomingHead > head:
+            this.upcomingHead = this.upcomingHead - 1
+            this.upcomingCount[this.playPitches[this.upcomingHead]] += 1
 
     def doUpdate(this):
+        # Draw the frame at the song time it will be shown at. Notes are played by accompanyThread.
+        this.pacer.startFrame()
+        this.timeCode = this.songClock.now() + this.pacer.presentDelay() / this.timeFactor
+        if this.loopStart is not None and this.timeCode >= this.loopEndTime():
+            this.seekMeasure(this.loopStart)
         this.updateScreen()
-        this.updateNoteQueue()
-        this.clock.tick(100)
-        this.timeCode = this.timeCode + this.clock.get_time()/1000/this.timeFactor
+        profiler.mark("screen")
+        this.pacer.wait()
+        profiler.mark("tick")
+        midiEvents, midiTime = this.accompanyThread.takeStats()
+        profiler.count("midi events", midiEvents)
+        profiler.add("midi", midiTime)
+
+    def resetNoteQueue(this):
+        this.accompanyThread.silence()
 
-    def resetNoteQueue(this, midiDevice):
-        for note in this.noteQueue:
-            pitch = 12 + 12*note.octave + note.tone
-            midiDevice.note_off(pitch)
+    def close(this):
+        this.accompanyThread.stop()
 
     def handleEvent(this, event):
         global paused
@@ -797,23 +1181,407 @@ class SongPlayer(AppMode):
             if event.key == pygame.K_SPACE:
                 ("Pause...")
                 paused = not paused
-                this.resetNoteQueue(midiDevice)
-                this.clock.tick()
+                this.resetNoteQueue()
+                if paused:
+                    this.accompanyThread.pause()
+                else:
+                    this.accompanyThread.resume()
             elif event.key == pygame.K_RETURN:
-                this.resetNoteQueue(midiDevice)
+                this.resetNoteQueue()
                 this.restartSong()
             elif event.key == pygame.K_DELETE:
-                this.resetNoteQueue(midiDevice)
+                this.resetNoteQueue()
                 this.restartSong()
             elif event.key == pygame.K_ESCAPE:
-                this.resetNoteQueue(midiDevice)
-                controller.active = controller.stack.pop()
+                if len(controller.stack) == 0:
+                    # Started from the command line, so there is nothing to go back to.
+                    this.done = True
+                else:
+                    this.close()
+                    controller.active = controller.stack.pop()
             elif event.key == pygame.K_PLUS or event.key == pygame.K_EQUALS:
                 this.tempo = this.tempo + 4
                 this.timeFactor = this.startTempo / this.tempo
+                this.accompanyThread.setTimeFactor(this.timeFactor)
             elif event.key == pygame.K_MINUS or event.key == pygame.K_UNDERSCORE:
                 this.tempo = this.tempo - 4
                 this.timeFactor = this.startTempo / this.tempo
+                this.accompanyThread.setTimeFactor(this.timeFactor)
+
+            # Practice: step through measures, go to a numbered one and loop a section
+            elif event.key == pygame.K_LEFT:
+                this.seekMeasure(this.currentMeasure() - 1)
+            elif event.key == pygame.K_RIGHT:
+                this.seekMeasure(this.currentMeasure() + 1)
+            elif event.unicode.isdigit():
+                this.measureEntry = this.measureEntry + event.unicode
+            elif event.key == pygame.K_g:
+                if this.measureEntry in this.measureIndex:
+                    this.seekMeasure(this.measureIndex[this.measureEntry])
+                this.measureEntry = ""
+            elif event.key == pygame.K_a:
+                # Loop from the current measure, to itself until B is pressed
+                this.setLoop(this.currentMeasure(), this.currentMeasure())
+            elif event.key == pygame.K_b and this.loopStart is not None:
+                this.setLoop(this.loopStart, this.currentMeasure())
+            elif event.key == pygame.K_c:
+                this.loopStart = None
+                this.loopEnd = None
+
+class SongClock():
+    # Song time in seconds, read from a monotonic clock and slowed down
+    # or sped up by the tempo factor. Shared by the screen and the MIDI thread.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.baseTime = 0.0
+        self.baseWall = time.perf_counter()
+        self.timeFactor = 1
+        self.paused = False
+
+    def now(self):
+        with self.lock:
+            if self.paused:
+                return self.baseTime
+            return self.baseTime + (time.perf_counter() - self.baseWall) / self.timeFactor
+
+    def wallDelay(self, songTime):
+        # Seconds of real time until the clock reaches songTime
+        return (songTime - self.now()) * self.timeFactor
+
+    def seek(self, songTime):
+        with self.lock:
+            self.baseTime = songTime
+            self.baseWall = time.perf_counter()
+
+    def setTimeFactor(self, timeFactor):
+        self.seek(self.now())
+        with self.lock:
+            self.timeFactor = timeFactor
+
+    def pause(self):
+        self.seek(self.now())
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.baseWall = time.perf_counter()
+            self.paused = False
+
+# How close to a note event the MIDI thread stops sleeping and spins, in seconds
+SPIN_TIME = 0.002
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+# PortMidi accepts at most this many events per write
+MIDI_WRITE_LIMIT = 1024
+
+class AccompanimentOutput(threading.Thread):
+    # What AccompanimentThread and SynthThread share: the song clock, the
+    # controls from the screen and the stats for the frame profiler. Controls
+    # take the condition lock and wake the thread. Subclasses play the notes
+    # in run, and provide silence and seek.
+    def __init__(self, accompaniment, songClock):
+        super().__init__(daemon=True)
+        # Only notes starting this long before a time can still be sounding at it.
+        self.longestNote = float(accompaniment["duration"].max()) if len(accompaniment) > 0 else 0.0
+        self.songClock = songClock
+        self.condition = threading.Condition()
+        self.stopped = False
+        # Notes played and seconds of work since the last takeStats
+        self.eventsSent = 0
+        self.busyTime = 0.0
+
+    def takeStats(self):
+        stats = (self.eventsSent, self.busyTime)
+        self.eventsSent = 0
+        self.busyTime = 0.0
+        return stats
+
+    def setTimeFactor(self, timeFactor):
+        with self.condition:
+            self.songClock.setTimeFactor(timeFactor)
+            self.condition.notify()
+
+    def pause(self):
+        with self.condition:
+            self.songClock.pause()
+            self.condition.notify()
+
+    def resume(self):
+        with self.condition:
+            self.songClock.resume()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.silence()
+            self.stopped = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+
+
+class AccompanimentThread(AccompanimentOutput):
+    # Plays the accompaniment notes on the MIDI device as the song clock reaches them.
+    #
+    # With a MIDI latency, events are written in timestamped batches up to lookahead
+    # ms early and PortMidi delivers them on time. Without one, each event is
+    # written immediately when it comes due.
+    def __init__(self, accompaniment, songClock, midiDevice, latency=0, lookahead=0):
+        super().__init__(accompaniment, songClock)
+        # Plain lists, since the thread reads one note at a time.
+        self.onsets = accompaniment["onset"].tolist()
+        self.offsets = (accompaniment["onset"] + accompaniment["duration"]).tolist()
+        self.pitches = accompaniment["pitch"].tolist()
+        self.midiDevice = midiDevice
+        self.latency = latency
+        if latency > 0:
+            # Batches must still arrive latency ms early when the thread wakes half way through the window.
+            self.lookahead = max(lookahead, 2*latency) / 1000
+        else:
+            self.lookahead = 0
+        # Timestamps written to PortMidi never go backwards.
+        self.lastStamp = 0
+        # Index of the next accompaniment note to turn on
+        self.nextAccompany = 0
+        # Min-heap of (note-off time, accompaniment index) for notes whose note-on was written
+        self.noteQueue = []
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                startTime = time.perf_counter()
+                delay = self.playDue()
+                self.busyTime = self.busyTime + time.perf_counter() - startTime
+                if delay is None:
+                    # Paused or finished: sleep until told otherwise.
+                    self.condition.wait()
+                elif self.latency > 0:
+                    # PortMidi does the fine timing, so wake at most twice per window.
+                    self.condition.wait(max(delay, self.lookahead / 2))
+                elif delay > SPIN_TIME:
+                    self.condition.wait(delay - SPIN_TIME)
+                else:
+                    # Spin the last moments for sub-millisecond timing.
+                    self.condition.release()
+                    time.sleep(0)
+                    self.condition.acquire()
+
+    def playDue(self):
+        global debugScore
+        songTime = self.songClock.now()
+        horizon = songTime + self.lookahead / self.songClock.timeFactor
+
+        # Collect the note-offs and note-ons within the window, in time order.
+        events = []
+        newNote = False
+        while True:
+            offDue = len(self.noteQueue) > 0 and self.noteQueue[0][0] <= horizon
+            onDue = self.nextAccompany < len(self.onsets) and self.onsets[self.nextAccompany] <= horizon
+            if offDue and (not onDue or self.noteQueue[0][0] <= self.onsets[self.nextAccompany]):
+                # Turn off a note that has finished.
+                offTime, i = heapq.heappop(self.noteQueue)
+                events.append((offTime, NOTE_OFF, 12 + self.pitches[i], 0))
+            elif onDue:
+                # Turn on a new note
+                i = self.nextAccompany
+                newNote = True
+                if debugScore:
+                    print(diatonicNames[self.pitches[i] % 12], self.pitches[i] // 12, sep='', end=' ')
+                events.append((self.onsets[i], NOTE_ON, 12 + self.pitches[i], 100))
+                heapq.heappush(self.noteQueue, (self.offsets[i], i))
+                self.nextAccompany = i + 1
+            else:
+                break
+        if newNote and debugScore:
+            print()
+        if len(events) > 0:
+            self.write(events)
+
+        # Real time until the next event enters the window
+        if self.songClock.paused:
+            return None
+        nextTime = None
+        if len(self.noteQueue) > 0:
+            nextTime = self.noteQueue[0][0]
+        if self.nextAccompany < len(self.onsets) and (nextTime is None or self.onsets[self.nextAccompany] < nextTime):
+            nextTime = self.onsets[self.nextAccompany]
+        if nextTime is None:
+            return None
+        return self.songClock.wallDelay(nextTime) - self.lookahead
+
+    def write(self, events):
+        # Send (songTime, status, pitch, velocity) events as timestamped batches.
+        batch = []
+        if self.latency > 0:
+            # PortMidi plays each event latency ms after its timestamp.
+            midiNow = pygame.midi.time()
+            for songTime, status, pitch, velocity in events:
+                stamp = midiNow + int(self.songClock.wallDelay(songTime) * 1000) - self.latency
+                self.lastStamp = max(self.lastStamp, stamp)
+                batch.append([[status, pitch, velocity], self.lastStamp])
+        else:
+            for songTime, status, pitch, velocity in events:
+                batch.append([[status, pitch, velocity], 0])
+        self.send(batch)
+
+    def send(self, batch):
+        for start in range(0, len(batch), MIDI_WRITE_LIMIT):
+            self.midiDevice.write(batch[start:start + MIDI_WRITE_LIMIT])
+        self.eventsSent = self.eventsSent + len(batch)
+
+    def silence(self):
+        # Turn off everything that is sounding or already queued in PortMidi.
+        # The note-offs carry the latest timestamp written, so they follow any
+        # note-on still waiting there. Notes are not resumed afterwards.
+        with self.condition:
+            batch = []
+            for offTime, i in self.noteQueue:
+                batch.append([[NOTE_OFF, 12 + self.pitches[i], 0], self.lastStamp])
+            self.send(batch)
+            self.noteQueue = []
+
+    def seek(self, songTime):
+        with self.condition:
+            self.silence()
+            self.songClock.seek(songTime)
+            self.nextAccompany = bisect.bisect_right(self.onsets, songTime)
+            if not self.songClock.paused:
+                # Sound the notes that are held across songTime, found by bisection
+                # rather than by playing the song up to there.
+                events = []
+                for i in range(bisect.bisect_left(self.onsets, songTime - self.longestNote), self.nextAccompany):
+                    if self.offsets[i] > songTime:
+                        events.append((songTime, NOTE_ON, 12 + self.pitches[i], 100))
+                        heapq.heappush(self.noteQueue, (self.offsets[i], i))
+                if len(events) > 0:
+                    self.write(events)
+            self.condition.notify()
+
+
+
+# The built in synthesizer's sound: samples per mixed block, the harmonics of
+# its wave and an envelope in seconds of real time
+SYNTH_RATE = 44100
+SYNTH_BLOCK = 1024
+SYNTH_MIXER_BUFFER = 512
+SYNTH_TABLE_SIZE = 2048
+SYNTH_HARMONICS = (1.0, 0.5, 0.3, 0.15, 0.08, 0.04)
+SYNTH_ATTACK = 0.005
+SYNTH_DECAY = 0.4
+SYNTH_SUSTAIN = 0.4
+SYNTH_RELEASE = 0.08
+# Level of one note, so chords of several notes still fit
+SYNTH_VOLUME = 0.15
+
+class SynthThread(AccompanimentOutput):
+    # Plays the accompaniment through pygame.mixer when there is no MIDI device,
+    # with the same controls as AccompanimentThread.
+    #
+    # Notes are mixed in blocks of SYNTH_BLOCK samples from a wavetable with an
+    # envelope per note. The channel holds the block playing and one queued
+    # behind it, so the synthesizer is never more than two blocks ahead of what
+    # is heard. Each block is mixed for the song time it will be heard at, found
+    # from the song clock, so seeks and tempo changes need no extra state.
+    def __init__(self, accompaniment, songClock):
+        super().__init__(accompaniment, songClock)
+        self.onsets = accompaniment["onset"].astype(float)
+        self.offsets = (accompaniment["onset"] + accompaniment["duration"]).astype(float)
+        self.frequencies = 440 * 2 ** ((accompaniment["pitch"].astype(float) + 12 - 69) / 12)
+        self.rate, sampleFormat, self.channels = pygame.mixer.get_init()
+        self.channel = pygame.mixer.Channel(0)
+        phases = np.arange(SYNTH_TABLE_SIZE) * 2 * np.pi / SYNTH_TABLE_SIZE
+        self.wavetable = sum(level * np.sin(harmonic * phases) for harmonic, level in enumerate(SYNTH_HARMONICS, 1))
+        self.wavetable = self.wavetable / np.abs(self.wavetable).max()
+        self.sampleTimes = np.arange(SYNTH_BLOCK) / self.rate
+        self.blockSeconds = SYNTH_BLOCK / self.rate
+        # The mixer takes blocks a buffer before they are heard.
+        self.outputDelay = SYNTH_MIXER_BUFFER / self.rate
+        # When the next block queued will start to be heard
+        self.nextWall = 0.0
+        # Notes starting before cutoff are not played, except that after a seek
+        # the notes held across it are started again at cutoff.
+        self.cutoff = -np.inf
+        self.restart = False
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                if self.songClock.paused:
+                    self.condition.wait()
+                    continue
+                startTime = time.perf_counter()
+                self.fill()
+                self.busyTime = self.busyTime + time.perf_counter() - startTime
+                self.condition.wait(self.blockSeconds / 4)
+
+    def fill(self):
+        # Keep one block playing and one queued behind it.
+        now = time.perf_counter()
+        if not self.channel.get_busy():
+            self.nextWall = now + self.outputDelay
+            self.channel.play(self.nextSound(now))
+        elif self.channel.get_queue() is None:
+            # The queued block has just started. If that is a block away from
+            # when it was due, after a stall or drift between the audio clock
+            # and ours, start timing again from here.
+            started = self.nextWall - self.blockSeconds - self.outputDelay
+            if abs(now - started) > self.blockSeconds:
+                self.nextWall = now + self.blockSeconds + self.outputDelay
+        if self.channel.get_queue() is None:
+            self.channel.queue(self.nextSound(now))
+
+    def nextSound(self, now):
+        # The block heard from nextWall on, as a Sound for the mixer
+        timeFactor = self.songClock.timeFactor
+        songTime = self.songClock.now() + (self.nextWall - now) / timeFactor
+        self.nextWall = self.nextWall + self.blockSeconds
+        samples = (np.clip(self.mix(songTime, timeFactor), -1, 1) * 32767).astype(np.int16)
+        if self.channels > 1:
+            samples = np.repeat(samples, self.channels)
+        return pygame.mixer.Sound(buffer=samples)
+
+    def mix(self, songTime, timeFactor):
+        # Samples from -1 to 1 of the block starting at songTime. Each sounding
+        # note is a row, so every note in the block is synthesized at once.
+        release = SYNTH_RELEASE / timeFactor
+        endTime = songTime + SYNTH_BLOCK / self.rate / timeFactor
+        first = np.searchsorted(self.onsets, songTime - self.longestNote - release)
+        last = np.searchsorted(self.onsets, endTime)
+        onsets = self.onsets[first:last]
+        offsets = self.offsets[first:last]
+        sounding = (offsets + release > songTime) & ((onsets >= self.cutoff) | (self.restart & (offsets > self.cutoff)))
+        starts = np.maximum(onsets[sounding], self.cutoff)
+        offsets = offsets[sounding]
+        frequencies = self.frequencies[first:last][sounding]
+        self.eventsSent = self.eventsSent + int(np.count_nonzero(starts >= songTime))
+
+        # Real seconds since each note started, at every sample
+        ages = ((songTime - starts) * timeFactor)[:, None] + self.sampleTimes
+        held = ((offsets - starts) * timeFactor)[:, None]
+        envelope = np.clip(ages / SYNTH_ATTACK, 0, 1)
+        envelope *= SYNTH_SUSTAIN + (1 - SYNTH_SUSTAIN) * np.exp(-np.maximum(ages, 0) / SYNTH_DECAY)
+        envelope *= np.clip(1 - (ages - held) / SYNTH_RELEASE, 0, 1)
+        phases = (ages * (frequencies[:, None] * SYNTH_TABLE_SIZE)).astype(np.int64) & (SYNTH_TABLE_SIZE - 1)
+        return (self.wavetable[phases] * envelope).sum(axis=0) * SYNTH_VOLUME
+
+    def silence(self):
+        # Stop everything that is sounding or already mixed. Notes are not resumed afterwards.
+        with self.condition:
+            self.channel.stop()
+            self.cutoff = self.songClock.now()
+            self.restart = False
+
+    def seek(self, songTime):
+        with self.condition:
+            self.silence()
+            self.songClock.seek(songTime)
+            # Notes held across songTime start again there, unless paused.
+            self.cutoff = songTime
+            self.restart = not self.songClock.paused
+            self.condition.notify()
+
+
 
 class ControlManager(object):
     stack = []
@@ -835,133 +1603,929 @@ def getNoteName(tone, adjust):
     return name
 
 def make_font(fonts, size):
-    available = pygame.font.get_fonts()
-    # get_fonts() returns a list of lowercase spaceless font names
-    choices = map(lambda x:x.lower().replace(' ', ''), fonts)
-    for choice in choices:
-        if choice in available:
-            return pygame.font.SysFont(choice, size)
-    return pygame.font.Font(None, size)
+    return pygame.font.Font(resolve_font(fonts), size)
+
+# Font files found for each preference list, kept between runs since
+# scanning the system fonts can take seconds
+_resolved_fonts = None
+def resolve_font(fonts):
+    # The file of the first installed font in the list, or None for the pygame default
+    global _resolved_fonts
+    indexPath = os.path.join(args.cacheDir, "fonts.json")
+    if _resolved_fonts is None:
+        try:
+            with open(indexPath) as indexFile:
+                _resolved_fonts = json.load(indexFile)
+        except (OSError, ValueError):
+            _resolved_fonts = dict()
+    key = "|".join(fonts)
+    fontPath = _resolved_fonts.get(key)
+    if fontPath is None or (fontPath != "" and not os.path.isfile(fontPath)):
+        startTime = time.perf_counter()
+        # get_fonts() returns a list of lowercase spaceless font names
+        available = pygame.font.get_fonts()
+        fontPath = ""
+        for choice in map(lambda x:x.lower().replace(' ', ''), fonts):
+            if choice in available:
+                fontPath = pygame.font.match_font(choice) or ""
+                break
+        _resolved_fonts[key] = fontPath
+        try:
+            os.makedirs(args.cacheDir, exist_ok=True)
+            with open(indexPath, "w") as indexFile:
+                json.dump(_resolved_fonts, indexFile)
+        except OSError as err:
+            print("Unable to save fonts:", err)
+        startupLog.add("font scan", time.perf_counter() - startTime)
+    return fontPath if fontPath != "" else None
 
 _cached_fonts = {}
 def get_font(font_preferences, size):
     global _cached_fonts
-    key = str(font_preferences) + '|' + str(size)
+    key = (font_preferences, size)
     font = _cached_fonts.get(key, None)
     if font == None:
         font = make_font(font_preferences, size)
         _cached_fonts[key] = font
     return font
 
-_cached_text = {}
+class SurfaceCache():
+    # Keeps the most recently used rendered surfaces, up to maxEntries of them.
+    # Keys must be hashable tuples, so fonts and colors are passed as tuples.
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+_cached_text = SurfaceCache(512)
 def create_text(text, fonts, size, color):
-    global _cached_text
-    key = '|'.join(map(str, (fonts, size, color, text)))
-    image = _cached_text.get(key, None)
-    if image == None:
+    key = (text, size, color, fonts)
+    image = _cached_text.get(key)
+    if image is None:
         font = get_font(fonts, size)
         image = font.render(text, True, color)
-        _cached_text[key] = image
+        _cached_text.put(key, image)
     return image
 
-nameFonts = ["Arial Unicode MS", "Helvetica"]
-
-class DrawNote():
-    def __init__(self, note, x, y, timeCode):
-        self.note = note
-        self.x = x
-        self.y = y
-        self.time = timeCode
-
-class Note():
-    def __init__(self, tone, adjust, octave, symbol, timeCode, timeLength):
-        self.tone = tone
-        self.adjust = adjust
-        self.octave = octave
-        self.symbol = symbol
-        self.timeCode = timeCode
-        self.timeLength = timeLength
-        self.index = ""
-
-    def draw(self, screen, pos, curTime):
-        global nameFonts
-
-        color = color_list[self.tone]
-        noteName = getNoteName(self.tone, self.adjust)
+nameFonts = ("Arial Unicode MS", "Helvetica")
+
+def drawNoteSprite(screen, tone, adjust, index, pos):
+    # Draw a note centered on pos, with any index label below it, and return the area covered.
+    sprite, center = create_note_sprite(tone, adjust)
+    area = screen.blit(sprite, (pos[0] - center[0], pos[1] - center[1]))
+    if index != "":
+        label, center = create_label_sprite(index)
+        area.union_ip(screen.blit(label, (pos[0] - center[0], pos[1] + 20 - center[1])))
+    return area
+
+_cached_sprites = SurfaceCache(256)
+def create_note_sprite(tone, adjust):
+    # A note fully drawn on its own surface: the colored circle and its name.
+    # Returns the surface and where the note center is on it.
+    key = (tone, adjust, NOTESIZE)
+    sprite = _cached_sprites.get(key)
+    if sprite is None:
+        noteName = getNoteName(tone, adjust)
         radius = NOTESIZE
-        noteRect = pygame.draw.circle(screen, color, pos, radius)
-        noteRect = pygame.draw.circle(screen, BLACK, pos, radius, 1)
-        drawText(noteName, pos, 18, WHITE, BLACK, True, True)
-        drawText(self.index, (pos[0], pos[1] + 20), 18, WHITE, BLACK, True, True)
+        # Leave room for the text shadows.
+        nameText = create_text(noteName, nameFonts, 18, WHITE)
+        halfWidth = max(radius, nameText.get_width() // 2 + 2)
+        halfHeight = max(radius, nameText.get_height() // 2 + 2)
+        center = (halfWidth + 1, halfHeight + 1)
+        surface = pygame.Surface((2*halfWidth + 2, 2*halfHeight + 2), pygame.SRCALPHA)
+        pygame.draw.circle(surface, color_list[tone], center, radius)
+        pygame.draw.circle(surface, BLACK, center, radius, 1)
+        drawText(noteName, center, 18, WHITE, BLACK, True, True, surface)
+        sprite = (surface, center)
+        _cached_sprites.put(key, sprite)
+    return sprite
+
+_cached_labels = SurfaceCache(512)
+def create_label_sprite(index):
+    # The shadowed index label drawn under a note, kept apart from the note
+    # so that counting down does not draw a new note for every count.
+    sprite = _cached_labels.get(index)
+    if sprite is None:
+        indexText = create_text(index, nameFonts, 18, WHITE)
+        center = (indexText.get_width() // 2 + 1, indexText.get_height() // 2 + 1)
+        surface = pygame.Surface((indexText.get_width() + 2, indexText.get_height() + 2), pygame.SRCALPHA)
+        drawText(index, center, 18, WHITE, BLACK, True, True, surface)
+        sprite = (surface, center)
+        _cached_labels.put(index, sprite)
+    return sprite
+
+# The surface caches by name, for the overlay and the benchmark
+surfaceCaches = {"text": _cached_text, "sprites": _cached_sprites, "labels": _cached_labels}
 
 
 # ----------
 #    This function imports the musicxml data from the song stored in filePath.
-#    It then pulls out the notes associated with the given parts for presentation
-#    in a music flow.
+#    It then pulls out the notes of every part for presentation in a music flow.
 #
-#    Returns a song object.
+#    Returns a CompiledScore object.
 # ----------
 
+# Plain musicxml, and musicxml compressed into a zip archive
+SCORE_SUFFIXES = ('.musicxml', '.mxl')
+
+def loadScore(filePath, progress=None):
+    # The file is streamed with iterparse. Each measure is compiled as soon as
+    # it has been read and then thrown away, so memory stays proportional to
+    # a single measure rather than to the whole score.
+    # progress, if given, is called with the fraction of the file read so far.
+    if filePath.endswith('.mxl'):
+        # The score is decompressed as it is read, without extracting it to disk.
+        with zipfile.ZipFile(filePath) as archive:
+            rootInfo = archive.getinfo(findRootFile(archive))
+            with archive.open(rootInfo) as scoreFile:
+                return readScore(scoreFile, rootInfo.file_size, progress)
+    with open(filePath, "rb") as scoreFile:
+        return readScore(scoreFile, os.fstat(scoreFile.fileno()).st_size, progress)
+
+def findRootFile(archive):
+    # The name of the score within a compressed .mxl archive. It is the first
+    # rootfile listed in META-INF/container.xml, or the first XML file outside
+    # META-INF when there is no container.
+    try:
+        container = ElementTree.fromstring(archive.read("META-INF/container.xml"))
+    except KeyError:
+        container = None
+    if container is not None:
+        for rootFile in container.iter("rootfile"):
+            if rootFile.get("full-path") is not None:
+                return rootFile.get("full-path")
+    for name in archive.namelist():
+        if not name.startswith("META-INF/") and name.endswith((".xml", ".musicxml")):
+            return name
+    raise KeyError("No score found in " + str(archive.filename))
+
+def readScore(scoreFile, fileSize, progress):
+    score = CompiledScore()
+    workTitle = None
+    movementTitle = None
+    scoreType = None
+    timeline = None
+    # Elements that have started but not yet ended
+    openElements = []
+    for event, elem in ElementTree.iterparse(scoreFile, events=("start", "end")):
+        if event == "start":
+            if scoreType is None:
+                scoreType = elem.tag
+                if scoreType == 'score-timewise':
+                    # This structure has multiple measures. Each measure has multiple parts.
+                    raise ValueError("score-timewise files are not supported")
+                elif scoreType != 'score-partwise':
+                    raise ValueError("Score structure not recognized: " + scoreType)
+            elif scoreType == 'score-partwise' and elem.tag == "part" and len(openElements) == 1:
+                # This structure has multiple parts. Each part has multiple measures.
+                # The first part's measures make the measure index.
+                measures = score.measures if len(score.notes) == 0 else None
+                timeline = PartTimeline(score.notes.setdefault(elem.get("id"), []), measures)
+            openElements.append(elem)
+            continue
+
+        openElements.pop()
+        if not openElements:
+            break
+        parent = openElements[-1]
+
+        if elem.tag == "measure" and timeline is not None:
+            timeline.readMeasure(elem, score)
+            parent.remove(elem)
+            if progress is not None:
+                progress(scoreFile.tell() / max(fileSize, 1))
+        elif elem.tag == "part-list":
+            # Find the list of parts.
+            for part in elem.iter("score-part"):
+                partID = part.get("id")
+                partName = part.find("part-name")
+                score.parts.append([partID, "" if partName is None or partName.text is None else partName.text])
+        elif elem.tag == "work-title" and parent.tag == "work":
+            workTitle = elem.text
+        elif elem.tag == "movement-title" and len(openElements) == 1:
+            movementTitle = elem.text
+
+        if len(openElements) == 1:
+            # Top level elements are no longer needed once they end.
+            timeline = None
+            parent.remove(elem)
+
+    # Find the title
+    for title in [workTitle, movementTitle]:
+        if title is not None:
+            score.title = title
+            break
+
+    score.tempoMarks.sort()
+    return score
+
+# ----------
+#    Compiled scores are cached on disk so a song that has been opened before
+#    does not need to be parsed again. Each entry is stamped with the cache
+#    version and the size and modification time of the file it came from.
+# ----------
+SCORE_CACHE_VERSION = 3
+# A cache that outgrows its size is cut back to this fraction of it, so the
+# next few misses do not each have to evict again
+CACHE_EVICT_TO = 0.9
+
+class ScoreCache():
+    def __init__(self, folder, maxBytes):
+        # A folder of None turns the cache off. A maxBytes of None leaves
+        # eviction to the caller.
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        # Size of the folder's entries, found by the last evict and kept up to
+        # date as entries are written. None until the folder has been read.
+        self.totalBytes = None
+        self.lock = threading.Lock()
+
+    def entryPath(self, filePath):
+        name = hashlib.sha1(os.path.abspath(filePath).encode("utf-8")).hexdigest()
+        return os.path.join(self.folder, name + ".score")
+
+    def load(self, filePath, progress=None):
+        if self.folder is None:
+            return loadScore(filePath, progress)
+        fileStat = os.stat(filePath)
+        stamp = (SCORE_CACHE_VERSION, os.path.abspath(filePath), fileStat.st_size, fileStat.st_mtime_ns)
+        entryPath = self.entryPath(filePath)
+        try:
+            with open(entryPath, "rb") as entry:
+                entryStamp, data = pickle.load(entry)
+            if entryStamp == stamp:
+                # Mark the entry as recently used for eviction.
+                os.utime(entryPath)
+                self.hits = self.hits + 1
+                score = CompiledScore()
+                score.title, score.startTempo, score.parts, score.notes, score.tempoMarks, score.measures = data
+                return score
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            # A missing or unreadable entry is just a miss.
+            pass
+
+        self.misses = self.misses + 1
+        score = loadScore(filePath, progress)
+        data = (score.title, score.startTempo, score.parts, score.notes, score.tempoMarks, score.measures)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            # Loading and library threads may write the same entry at once.
+            tempPath = entryPath + ".tmp" + str(os.getpid()) + "." + str(threading.get_ident())
+            with open(tempPath, "wb") as entry:
+                pickle.dump((stamp, data), entry, pickle.HIGHEST_PROTOCOL)
+            addedBytes = os.path.getsize(tempPath)
+            if os.path.exists(entryPath):
+                addedBytes = addedBytes - os.path.getsize(entryPath)
+            os.replace(tempPath, entryPath)
+            if self.maxBytes is not None:
+                # The folder is only read again once the running total is over the limit.
+                with self.lock:
+                    if self.totalBytes is not None:
+                        self.totalBytes = self.totalBytes + addedBytes
+                    if self.totalBytes is None or self.totalBytes > self.maxBytes:
+                        self.evict(int(self.maxBytes * CACHE_EVICT_TO))
+        except OSError as err:
+            print("Unable to cache score:", err)
+        return score
+
+    def evict(self, targetBytes=None):
+        # Remove the least recently used entries until the cache fits in
+        # targetBytes, by default its size. Returns how many were removed.
+        if targetBytes is None:
+            targetBytes = self.maxBytes
+        entries = []
+        totalBytes = 0
+        with os.scandir(self.folder) as folder:
+            for entry in folder:
+                if entry.name.endswith(".score"):
+                    entryStat = entry.stat()
+                    entries.append((entryStat.st_mtime, entryStat.st_size, entry.path))
+                    totalBytes = totalBytes + entryStat.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if totalBytes <= targetBytes:
+                break
+            os.remove(path)
+            totalBytes = totalBytes - size
+            removed = removed + 1
+        self.totalBytes = totalBytes
+        return removed
+
+class PartTimeline():
+    # Running position within one part while its measures are read, in beats.
+    def __init__(self, noteTable, measures=None):
+        self.noteTable = noteTable
+        self.measures = measures
+        self.timeCode = 0.0
+        self.lastTime = 0.0
+        self.beatDivisions = 1
+
+    def readMeasure(self, measure, score):
+        if self.measures is not None:
+            self.measures.append((self.timeCode, measure.get("number", "")))
+        # Within each measure, go through each element.
+        # Some elements are about attributes.
+        # Others are notes, rests or other timing items.
+        for musicUnit in measure:
+            if musicUnit.tag == "attributes":
+                # Duration values count divisions of a beat.
+                divisions = musicUnit.find("divisions")
+                if divisions is not None:
+                    self.beatDivisions = int(divisions.text)
+
+            elif musicUnit.tag == "direction":
+                # Tempo is hidden in direction including "sound"
+                soundFeature = musicUnit.find("sound")
+                if soundFeature is not None and soundFeature.get("tempo") is not None:
+                    tempo = int(float(soundFeature.get("tempo")))
+                    # A tempo of 0 is allowed but gives no speed to play at.
+                    if tempo > 0:
+                        score.tempoMarks.append((self.timeCode, tempo))
+                        if score.startTempo is None:
+                            score.startTempo = tempo
+
+            elif musicUnit.tag == "note":
+                durationInfo = musicUnit.find("duration")
+                # Grace notes take no time.
+                timeLength = 0 if durationInfo is None else int(durationInfo.text) / self.beatDivisions
+                if musicUnit.find("chord") is not None:
+                    self.timeCode = self.lastTime
+                tieInfo = musicUnit.find("tie")
+                if tieInfo is not None:
+                    typeOfTie = tieInfo.get("type")
+                else:
+                    typeOfTie = "none"
+
+                # If it is not a rest, then pull out the pitch information.
+                pitchInfo = musicUnit.find("pitch")
+                if pitchInfo is not None and (tieInfo is None or typeOfTie == "start"):
+                    tone, adjust, octave = readPitch(pitchInfo)
+                    # What type of note?
+                    symbol = musicUnit.find("type").text
+                    self.noteTable.append((self.timeCode, timeLength, tone, adjust, octave, symbol))
+
+                self.lastTime = self.timeCode
+                self.timeCode = self.timeCode + timeLength
+
+            # Shift time backwards to get additional notes in the measure
+            elif musicUnit.tag == "backup":
+                self.timeCode = self.timeCode - int(musicUnit.find("duration").text) / self.beatDivisions
+                self.lastTime = self.timeCode
+
+            # Shift time forwards without rest to get next note in the measure
+            elif musicUnit.tag == "forward":
+                self.timeCode = self.timeCode + int(musicUnit.find("duration").text) / self.beatDivisions
+                self.lastTime = self.timeCode
+
+def readPitch(pitchInfo):
+    octave = pitchInfo.find("octave")
+    step = pitchInfo.find("step")
+    alter = pitchInfo.find("alter")
+
+    # Translate to standard information
+    tone = toneLookup.get(step.text)
+    adjust = 0
+    if alter is not None:
+        adjust = int(alter.text)
+        tone = tone + adjust
+    if octave is None:
+        octave = 4
+    else:
+        octave = int(octave.text)
+
+    # Standardize in case sharps or flats shift to different octave
+    noteIndex = 12*octave+tone
+    return noteIndex % 12, adjust, noteIndex // 12
+
+def foldOctave(tone, octave):
+    # Shift a played note by octaves until it fits on the screen.
+    while 12*octave + tone > HIGHEST_NOTE:
+        octave = octave - 1
+    while 12*octave + tone < LOWEST_NOTE:
+        octave = octave + 1
+    return octave
+
 def drawDashedHLine(screen, y, onDash, offDash):
-    x=0
-    while x < WIDTH:
-        pygame.draw.line(screen, BLACK, [x,y], [x+onDash,y], 1)
-        x = x + onDash + offDash
-
-
-# Initialize the game engine
-pygame.init()
-musicFont = pygame.font.SysFont("comicsansms", 18)
-
-# Set the height and width of the screen
-screen = pygame.display.set_mode((1400,840))
-print(screen)
-pygame.display.set_caption("Falling Music")
-WIDTH = screen.get_width()
-HEIGHT = screen.get_height()
-STARTLINE = 60
-FLASHLINE = int(0.8 * HEIGHT)
-if args.octaves=='1':
-    NOTESIZE = 36
-else:
-    NOTESIZE = 18
+    return screen.blit(create_dashed_line(onDash, offDash), (0, y))
+
+_cached_dashes = {}
+def create_dashed_line(onDash, offDash):
+    # A one pixel high strip across the screen with the dashes already drawn
+    global _cached_dashes
+    key = (onDash, offDash, WIDTH)
+    strip = _cached_dashes.get(key, None)
+    if strip == None:
+        strip = pygame.Surface((WIDTH, 1))
+        strip.fill(WHITE)
+        strip.set_colorkey(WHITE)
+        x=0
+        while x < WIDTH:
+            pygame.draw.line(strip, BLACK, [x,0], [x+onDash,0], 1)
+            x = x + onDash + offDash
+        _cached_dashes[key] = strip
+    return strip
+
+def drawBackground(title, tempo, status=""):
+    screen.blit(create_background(title, tempo, status), (0, 0))
+
+# The screen background only changes when the title, tempo or status does.
+_cached_background = [None, None]
+def create_background(title, tempo, status=""):
+    global _cached_background
+    key = (title, tempo, status, WIDTH, HEIGHT, FLASHLINE)
+    if _cached_background[0] != key:
+        background = pygame.Surface((WIDTH, HEIGHT))
+        background.fill(WHITE)
+
+        # Draw the line where we should play.
+        pygame.draw.line(background, BLACK, [0,FLASHLINE], [WIDTH,FLASHLINE], 5)
+
+        # Draw the title of the song
+        drawText(title, (WIDTH // 2, HEIGHT // 4), 36, GRAY, centerX= True, surface= background)
+
+        # Draw BPM
+        drawText(str(tempo) + " bpm", (WIDTH // 2, HEIGHT // 4 + 36), 24, GRAY, centerX= True, surface= background)
+
+        # Draw where the song is, such as the measure and loop
+        if status != "":
+            drawText(status, (WIDTH // 2, HEIGHT // 4 + 66), 24, GRAY, centerX= True, surface= background)
+        _cached_background = [key, background]
+    return _cached_background[1]
+
+
+class StartupLog():
+    # Prints how long each step of starting up takes, with --startup-times.
+    def __init__(self):
+        self.enabled = False
+        self.startTime = time.perf_counter()
+        self.lastMark = self.startTime
+        self.firstFrames = set()
+
+    def start(self):
+        self.startTime = time.perf_counter()
+        self.lastMark = self.startTime
+
+    def mark(self, step):
+        # The time since the previous mark went to step.
+        now = time.perf_counter()
+        if self.enabled:
+            print("startup %8.1f ms  %-18s %8.1f ms total" % (1000 * (now - self.lastMark), step, 1000 * (now - self.startTime)))
+        self.lastMark = now
+
+    def add(self, step, seconds):
+        # Time taken by step inside another one, such as a font scan while drawing.
+        if self.enabled:
+            print("startup %8.1f ms  %-18s (within the next step)" % (1000 * seconds, step))
+
+    def frameShown(self, mode):
+        # Marks the first frame of each kind of screen. A loader can finish
+        # before anything is drawn, leaving no mode on the display.
+        if self.enabled and mode is not None and type(mode) not in self.firstFrames:
+            self.firstFrames.add(type(mode))
+            self.mark("first " + type(mode).__name__)
+
+startupLog = StartupLog()
+
+# Frames of drawing time looked at before the pacer changes rate
+PACING_FRAMES = 30
+# The pacer does not slow down below this rate
+MIN_FPS = 20
+
+class FramePacer():
+    # Spaces the player's frames evenly at a target rate. When drawing keeps
+    # taking most of a frame, the rate is divided down (60, 30, 20 and so on)
+    # so the frames stay even, and raised again once there is room. Notes are
+    # placed from the song clock, so the rate never changes musical time.
+    def __init__(self, targetFps, vsync, refreshRate):
+        self.targetFps = targetFps
+        self.vsync = vsync
+        self.refreshRate = refreshRate
+        self.divisor = 1
+        self.drawTimes = collections.deque(maxlen=PACING_FRAMES)
+        self.frameStart = time.perf_counter()
+        self.drawEnd = self.frameStart
+        self.nextFrame = self.frameStart
+
+    def fps(self):
+        return self.targetFps / self.divisor
+
+    def presentDelay(self):
+        # Seconds from reading the song clock to the frame being on the display.
+        # With vsync the frame waits for the next refresh.
+        return 1 / self.refreshRate if self.vsync else 0
+
+    def startFrame(self):
+        self.frameStart = time.perf_counter()
+
+    def frameDrawn(self):
+        # Called before the frame is shown, which may wait for the display.
+        self.drawEnd = time.perf_counter()
+
+    def wait(self):
+        # Sleep until the next frame is due, adjusting the rate to the drawing time.
+        self.drawTimes.append(self.drawEnd - self.frameStart)
+        if len(self.drawTimes) == PACING_FRAMES:
+            typical = sorted(self.drawTimes)[PACING_FRAMES // 2]
+            if typical > 0.8 * self.divisor / self.targetFps and self.targetFps / (self.divisor + 1) >= MIN_FPS:
+                self.divisor = self.divisor + 1
+                self.drawTimes.clear()
+            elif self.divisor > 1 and typical < 0.4 * (self.divisor - 1) / self.targetFps:
+                self.divisor = self.divisor - 1
+                self.drawTimes.clear()
+
+        now = time.perf_counter()
+        self.nextFrame = self.nextFrame + self.divisor / self.targetFps
+        if self.nextFrame < now - self.divisor / self.targetFps:
+            # More than a frame late, after a pause or a stall. Start again from
+            # now rather than hurrying to catch up.
+            self.nextFrame = now
+        elif self.vsync and self.fps() >= self.refreshRate:
+            # Showing the frame already waited for the display. Slower rates
+            # sleep to their deadline and the flip lines up with the refresh after.
+            self.nextFrame = now
+        elif self.nextFrame > now:
+            time.sleep(self.nextFrame - now)
+
+# Number of frames of timing kept for the overlay and the trace
+PROFILE_FRAMES = 6000
+# Frames summarized by the overlay
+OVERLAY_FRAMES = 200
+
+class FrameProfiler():
+    # Times each phase of the main loop into a ring buffer of recent frames.
+    # Nothing is recorded unless it is enabled. "midi" is time spent on the
+    # accompaniment thread, so it is not part of the frame total.
+    columns = ["frame", "start", "events", "screen", "tick", "midi", "total", "notes", "midi events"]
+
+    def __init__(self):
+        self.enabled = False
+        self.visible = False
+        self.frames = collections.deque(maxlen=PROFILE_FRAMES)
+        self.frameNumber = 0
+        self.startFrame()
+
+    def startFrame(self):
+        self.frameStart = time.perf_counter()
+        self.lastMark = self.frameStart
+        self.current = dict()
+
+    def mark(self, phase):
+        # Charge the time since the previous mark to phase.
+        if self.enabled:
+            now = time.perf_counter()
+            self.current[phase] = self.current.get(phase, 0) + now - self.lastMark
+            self.lastMark = now
+
+    def add(self, phase, seconds):
+        if self.enabled:
+            self.current[phase] = self.current.get(phase, 0) + seconds
+
+    def count(self, counter, amount):
+        if self.enabled:
+            self.current[counter] = self.current.get(counter, 0) + amount
+
+    def endFrame(self):
+        if self.enabled:
+            now = time.perf_counter()
+            self.frameNumber = self.frameNumber + 1
+            record = [self.frameNumber, self.frameStart]
+            for column in self.columns[2:]:
+                record.append(self.current.get(column, 0))
+            record[self.columns.index("total")] = now - self.frameStart
+            self.frames.append(record)
+        self.startFrame()
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.enabled = self.enabled or self.visible
+
+    def drawOverlay(self):
+        # Draw the frame rate, frame time percentiles, notes, MIDI events and
+        # surface cache use since starting in the bottom corner.
+        if not self.visible or len(self.frames) == 0:
+            return ()
+        recent = list(self.frames)[-OVERLAY_FRAMES:]
+        totals = sorted(record[6] for record in recent)
+        elapsed = recent[-1][1] + recent[-1][6] - recent[0][1]
+        lines = [
+            "%.0f fps" % (len(recent) / elapsed if elapsed > 0 else 0),
+            "frame p50 %.1f ms  p99 %.1f ms" % (1000 * totals[len(totals) // 2], 1000 * totals[min(len(totals) - 1, len(totals) * 99 // 100)]),
+            "notes drawn %d" % recent[-1][7],
+            "midi events %d/s" % (sum(record[8] for record in recent) / elapsed if elapsed > 0 else 0),
+        ]
+        hits = sum(cache.hits for cache in surfaceCaches.values())
+        lookups = hits + sum(cache.misses for cache in surfaceCaches.values())
+        evictions = sum(cache.evictions for cache in surfaceCaches.values())
+        lines.append("cache hits %d%%  evicted %d" % (100 * hits // lookups if lookups > 0 else 100, evictions))
+        LINEHEIGHT = 18
+        overlayHeight = LINEHEIGHT * len(lines) + 6
+        overlayRect = pygame.Rect(0, HEIGHT - overlayHeight, 260, overlayHeight)
+        pygame.draw.rect(screen, BLACK, overlayRect)
+        for row, line in enumerate(lines):
+            drawText(line, (5, overlayRect.top + 3 + row * LINEHEIGHT), LINEHEIGHT, WHITE)
+        return [overlayRect]
+
+    def writeTrace(self, path):
+        # Save the recorded frames as JSON or, by default, CSV. Times are in seconds.
+        if path.endswith(".json"):
+            with open(path, "w") as traceFile:
+                json.dump([dict(zip(self.columns, record)) for record in self.frames], traceFile)
+        else:
+            with open(path, "w", newline="") as traceFile:
+                writer = csv.writer(traceFile)
+                writer.writerow(self.columns)
+                writer.writerows(self.frames)
+
+profiler = FrameProfiler()
+
+def initDisplay(size = (1400,840)):
+    global screen, WIDTH, HEIGHT, STARTLINE, FLASHLINE, NOTESIZE, vsync, refreshRate
+
+    # Initialize the game engine
+    pygame.init()
+    startupLog.mark("pygame init")
+
+    # Set the height and width of the screen. Vsync needs a scaled display.
+    vsync = False
+    if args.vsync:
+        try:
+            screen = pygame.display.set_mode(size, pygame.SCALED, vsync=1)
+            vsync = True
+        except pygame.error as err:
+            print("Vsync is not available:", err)
+    if not vsync:
+        screen = pygame.display.set_mode(size)
+    refreshRate = displayRefreshRate(vsync)
+    startupLog.mark("display")
+    print(screen)
+    pygame.display.set_caption("Falling Music")
+    WIDTH = screen.get_width()
+    HEIGHT = screen.get_height()
+    STARTLINE = 60
+    FLASHLINE = int(0.8 * HEIGHT)
+    if args.octaves=='1':
+        NOTESIZE = 36
+    else:
+        NOTESIZE = 18
+
+# Flips timed to measure the refresh rate with vsync
+REFRESH_SAMPLES = 12
+
+def displayRefreshRate(vsync):
+    # The desktop refresh rate. Only pygame-ce reports it. Otherwise, with
+    # vsync each flip waits for the next refresh, so the rate is measured from
+    # a few flips. Without either the rate is not known and 60 is assumed.
+    try:
+        rates = pygame.display.get_desktop_refresh_rates()
+    except (AttributeError, pygame.error):
+        rates = []
+    if len(rates) > 0 and rates[0] > 0:
+        return rates[0]
+    if vsync:
+        pygame.display.flip()
+        flipTimes = []
+        lastFlip = time.perf_counter()
+        for sample in range(REFRESH_SAMPLES):
+            pygame.display.flip()
+            flipTimes.append(time.perf_counter() - lastFlip)
+            lastFlip = time.perf_counter()
+        typical = sorted(flipTimes)[REFRESH_SAMPLES // 2]
+        # Flips that do not wait for the display tell nothing.
+        if 1 / 400 < typical < 1 / MIN_FPS:
+            return round(1 / typical)
+    return 60
+
+def openMidi():
+    # Find a MIDI synthesizer
+    pygame.midi.init()
+
+    # Find the synthesizer
+    midiDeviceNumber = pygame.midi.get_default_output_id()
+    return pygame.midi.Output(midiDeviceNumber, latency=args.latency)
+
+def openSynth():
+    # Set up the mixer for the built in synthesizer, with a channel of its own
+    pygame.mixer.quit()
+    pygame.mixer.init(SYNTH_RATE, -16, 2, SYNTH_MIXER_BUFFER)
+    pygame.mixer.set_reserved(1)
+
+def openAccompaniment():
+    # The MIDI device to accompany on, or None for the built in synthesizer
+    if args.synth != 'soft':
+        try:
+            return openMidi()
+        except pygame.midi.MidiException as err:
+            if args.synth == 'midi':
+                raise
+            print("No MIDI output, using the built in synthesizer:", err)
+    openSynth()
+    return None
 
 # How many seconds worth of advance notice?
 timeOnScreen = 4
 paused = False
 
-# Find a MIDI synthesizer
-pygame.midi.init()
+# Compiled scores are kept between runs
+scoreCache = ScoreCache(None, 0)
 
-# Find the synthesizer
-midiDeviceNumber = pygame.midi.get_default_output_id()
-midiDevice = pygame.midi.Output(midiDeviceNumber)
+# Song details for the selector, or None without an index
+library = None
 
-# Create an empty array
-numcolors = len(color_list)
-color_width = WIDTH // numcolors + 1
+def openLibrary(path=None):
+    # The song library at path, by default in the cache folder
+    if path is None:
+        path = os.path.join(args.cacheDir, 'library.sqlite')
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return SongLibrary(path)
+    except (OSError, sqlite3.Error) as err:
+        print("Unable to open song library:", err)
+        return None
 
-workNote = QuarterNote(3, 4, 4, True)
-controller = ControlManager()
-controller.active = SongSelector()
-
-print(args.folder)
-controller.active.loadSongList(args.folder)
-
-while (not controller.active.done):
-    # Deal with event management
-    for event in pygame.event.get():   # User did something
-        controller.active.handleEvent(event)
+# ----------
+#    Batch compiling. Every score under a folder is compiled into the score
+#    cache and the song library on all cores, without opening a window.
+# ----------
 
-    if paused:
-        pygame.time.wait(200)
-        continue
+def startPrecompileWorker(cacheDir):
+    global scoreCache
+    # Workers never evict, so they cannot remove each other's new entries.
+    scoreCache = ScoreCache(cacheDir, None)
+
+def precompileScore(path):
+    # Compile one score in a worker process.
+    # Returns (path, seconds, cache hit, (size, mtime), describeScore details, error).
+    startTime = time.perf_counter()
+    try:
+        fileStat = os.stat(path)
+        hits = scoreCache.hits
+        score = scoreCache.load(path)
+        return (path, time.perf_counter() - startTime, scoreCache.hits > hits,
+            (fileStat.st_size, fileStat.st_mtime_ns), describeScore(score), None)
+    except Exception as err:
+        return (path, time.perf_counter() - startTime, False, None, None, str(err))
+
+def precompile(folder):
+    # Returns the exit status, 1 if any score failed.
+    paths = []
+    for dirPath, dirNames, fileNames in os.walk(folder):
+        dirNames.sort()
+        for name in sorted(fileNames):
+            if name.endswith(SCORE_SUFFIXES):
+                paths.append(os.path.abspath(os.path.join(dirPath, name)))
+
+    cacheDir = None if args.noCache else args.cacheDir
+    precompileLibrary = openLibrary(args.library)
+    connection = precompileLibrary.connect() if precompileLibrary is not None else None
+    compiled = 0
+    cached = 0
+    failures = 0
+    parseTime = 0.0
+    startTime = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs if args.jobs > 0 else None,
+            initializer=startPrecompileWorker, initargs=(cacheDir,)) as pool:
+        for path, seconds, hit, stamp, info, error in pool.map(precompileScore, paths, chunksize=4):
+            parseTime = parseTime + seconds
+            if error is not None:
+                failures = failures + 1
+                print("  FAILED    %s: %s" % (path, error))
+                continue
+            if hit:
+                cached = cached + 1
+                print("  cached    %s" % path)
+            else:
+                compiled = compiled + 1
+                print("%8.1f ms  %s" % (1000 * seconds, path))
+            if connection is not None:
+                precompileLibrary.storeSong(connection, path, stamp[0], stamp[1], info)
+    if connection is not None:
+        connection.commit()
+        connection.close()
+
+    print("Compiled %d, already cached %d, failed %d of %d files in %.1f s (%.1f s of compiling)" %
+        (compiled, cached, failures, len(paths), time.perf_counter() - startTime, parseTime))
+    if cacheDir is not None and os.path.isdir(cacheDir):
+        evicted = ScoreCache(cacheDir, args.cacheSize * 1024 * 1024).evict()
+        if evicted > 0:
+            print("Evicted %d cache entries to stay within --cache-size %d MB" % (evicted, args.cacheSize))
+    return 1 if failures > 0 else 0
 
-    # Update processes and graphics
-    controller.active.doUpdate()
+# ----------
+#    Direct launch. With --music the song is parsed and compiled on a worker
+#    while the display and MIDI open, and plays without the song list.
+# ----------
 
-# Be IDLE friendly. If you forget this line, the program will 'hang' on exit.
-print("Cleaning Up.")
-pygame.quit()
-sys.exit()
+def findParts(score, partList):
+    # The IDs of the parts named in a comma separated list of part IDs or names
+    partIDs = []
+    for name in partList.split(','):
+        name = name.strip()
+        for partID, partName in score.parts:
+            if name == partID or name.lower() == partName.lower():
+                partIDs.append(partID)
+                break
+        else:
+            print("No part", name, "in", score.title)
+    return partIDs
+
+def launchSong(songPath):
+    # A SongLoader, already working, that goes on to play songPath
+    player = SongPlayer()
+    def compileSong(progress):
+        score = scoreCache.load(songPath, progress)
+        players = findParts(score, args.voices) if args.voices is not None else [part[0] for part in score.parts[:1]]
+        # Named parts that are all missing leave no accompaniment rather than every part.
+        accompany = findParts(score, args.accompanyParts) if args.accompanyParts is not None else None
+        tempo = score.startTempo if score.startTempo is not None else SongStartup.tempo
+        player.compile(score, players, accompany, args.octaves, score.title, tempo)
+    def showPlayer(result):
+        player.start()
+        controller.active = player
+    loader = SongLoader()
+    loader.initialize(None, os.path.basename(songPath), compileSong, showPlayer)
+    return loader
+
+def main():
+    global args, scoreCache, library, midiDevice, controller, presentedMode
+    args = parser.parse_args()
+    startupLog.enabled = args.startupTimes
+    startupLog.start()
+    if args.precompile is not None:
+        sys.exit(precompile(args.precompile))
+
+    profiler.enabled = args.profile or args.trace is not None
+    profiler.visible = args.profile
+
+    scoreCache = ScoreCache(None if args.noCache else args.cacheDir, args.cacheSize * 1024 * 1024)
+    controller = ControlManager()
+    if args.music is not None:
+        # Start on the song before anything else, so it is ready sooner.
+        controller.active = launchSong(args.music)
+
+    initDisplay()
+    midiDevice = openAccompaniment()
+    startupLog.mark("midi")
+
+    if args.music is None:
+        library = openLibrary(args.library)
+        controller.active = SongSelector()
+        print(args.folder)
+        controller.active.loadSongList(args.folder)
+        startupLog.mark("song list")
+
+    while (not controller.active.done):
+        events = []
+        if not controller.active.isAnimating():
+            # Nothing moves on screen, so sleep until something happens.
+            events.append(pygame.event.wait())
+        profiler.startFrame()
+        # Deal with event management
+        events.extend(pygame.event.get())
+        for event in events:   # User did something
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                profiler.toggle()
+            elif event.type == pygame.WINDOWEXPOSED:
+                # The window contents were lost, so the next frame is drawn in full.
+                presentedMode = None
+            else:
+                controller.active.handleEvent(event)
+        profiler.mark("events")
+
+        # Update processes and graphics
+        controller.active.doUpdate()
+        startupLog.frameShown(presentedMode)
+        profiler.endFrame()
+
+    # Be IDLE friendly. If you forget this line, the program will 'hang' on exit.
+    print("Cleaning Up.")
+    controller.active.close()
+    if args.trace is not None:
+        profiler.writeTrace(args.trace)
+    pygame.quit()
+    sys.exit()
+
+if __name__ == "__main__":
+    main()
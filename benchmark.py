@@ -0,0 +1,271 @@
+# Headless benchmarks for Boom_Waquiro.
+#
+# Runs without a window or a synthesizer: SDL uses its dummy video and audio
+# drivers, MIDI goes to a stub output that only counts events and blocks of the
+# built in synthesizer are mixed but not played. Every song in music/ is
+# measured, along with synthetic scores made by repeating each song's measures
+# and parts. Results are written as JSON so runs can be compared.
+#
+#    python benchmark.py --output bench.json
+#
+# Only the report goes to stdout, so it can be piped. Anything the game prints
+# while being measured goes to stderr.
+#
+# With --check-allocations it also fails, with exit status 1, if the render
+# loop keeps allocating memory or sets off the garbage collector once every
+# sprite it needs has been drawn.
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import argparse
+import contextlib
+import copy
+import gc
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from xml.etree import ElementTree
+
+import Boom_Waquiro as bw
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+parser = argparse.ArgumentParser(description='Benchmark parsing, scheduling and rendering without a display')
+parser.add_argument('--folder', dest='folder', default=os.path.join(baseDir, 'music'), help='folder of .musicxml files to measure')
+parser.add_argument('--scales', dest='scales', default='10,100', help='comma separated measure repeat counts for synthetic scores')
+parser.add_argument('--parts', dest='parts', type=int, default=8, help='part copies for the synthetic many-part score, 0 to skip')
+parser.add_argument('--frames', dest='frames', type=int, default=300, help='frames rendered per score')
+parser.add_argument('--output', dest='output', help='write the JSON report here instead of stdout')
+parser.add_argument('--check-allocations', dest='checkAllocations', action='store_true', help='exit with status 1 if the steady-state render loop allocates')
+
+# Memory the render loop may hold on to across a whole pass, in KB
+ALLOCATION_LIMIT_KB = 16
+
+
+class StubMidiOutput():
+    # Stands in for pygame.midi.Output and counts what would have been sent.
+    def __init__(self):
+        self.events = 0
+
+    def write(self, batch):
+        self.events = self.events + len(batch)
+
+    def note_on(self, pitch, velocity):
+        self.events = self.events + 1
+
+    def note_off(self, pitch):
+        self.events = self.events + 1
+
+
+class SteppedClock():
+    # A song clock that only moves when the benchmark moves it.
+    def __init__(self):
+        self.songTime = 0.0
+        self.timeFactor = 1
+        self.paused = False
+
+    def now(self):
+        return self.songTime
+
+    def wallDelay(self, songTime):
+        return (songTime - self.songTime) * self.timeFactor
+
+
+def scaleScore(sourcePath, targetPath, repeats, partCopies):
+    # Write a copy of a score with every part's measures repeated and every part duplicated.
+    tree = ElementTree.parse(sourcePath)
+    root = tree.getroot()
+    partList = root.find("part-list")
+    for part in list(root.findall("part")):
+        measures = list(part.findall("measure"))
+        for repeat in range(1, repeats):
+            for measure in measures:
+                part.append(copy.deepcopy(measure))
+        for number, measure in enumerate(part.findall("measure")):
+            measure.set("number", str(number + 1))
+    for copyNumber in range(1, partCopies):
+        for scorePart in list(partList.findall("score-part")):
+            newPart = copy.deepcopy(scorePart)
+            newPart.set("id", scorePart.get("id") + "c" + str(copyNumber))
+            partList.append(newPart)
+        for part in list(root.findall("part")):
+            if "c" not in part.get("id"):
+                newPart = copy.deepcopy(part)
+                newPart.set("id", part.get("id") + "c" + str(copyNumber))
+                root.append(newPart)
+    tree.write(targetPath, encoding="UTF-8", xml_declaration=True)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timings(samples):
+    # Summary of a list of durations in seconds, reported in milliseconds
+    return {
+        "mean_ms": 1000 * sum(samples) / len(samples),
+        "p50_ms": 1000 * percentile(samples, 0.5),
+        "p99_ms": 1000 * percentile(samples, 0.99),
+        "max_ms": 1000 * max(samples),
+    }
+
+
+def measureScore(path, frameCount):
+    result = {"file": os.path.basename(path), "bytes": os.path.getsize(path)}
+
+    startTime = time.perf_counter()
+    score = bw.loadScore(path)
+    result["parse_ms"] = 1000 * (time.perf_counter() - startTime)
+    result["parts"] = len(score.parts)
+    result["notes"] = sum(len(noteTable) for noteTable in score.notes.values())
+
+    # Play along with the first part and accompany with all of them.
+    players = [score.parts[0][0]] if len(score.parts) > 0 else []
+    tempo = score.startTempo if score.startTempo is not None else 80
+    player = bw.SongPlayer()
+    startTime = time.perf_counter()
+    player.initialize(score, players, None, bw.args.octaves, score.title, tempo)
+    result["initialize_ms"] = 1000 * (time.perf_counter() - startTime)
+    player.close()
+
+    # Step evenly through the whole song, timing each frame and each scheduler pass.
+    songLength = max((player.accompaniment["onset"] + player.accompaniment["duration"]).tolist() + [1])
+    midiDevice = StubMidiOutput()
+    songClock = SteppedClock()
+    scheduler = bw.AccompanimentThread(player.accompaniment, songClock, midiDevice)
+    synth = bw.SynthThread(player.accompaniment, songClock)
+    screenTimes = []
+    scheduleTimes = []
+    synthTimes = []
+    cachesBefore = cacheCounts()
+    for frame in range(frameCount):
+        songTime = -bw.timeOnScreen + (songLength + bw.timeOnScreen) * frame / frameCount
+        player.timeCode = songTime
+        startTime = time.perf_counter()
+        player.updateScreen()
+        screenTimes.append(time.perf_counter() - startTime)
+
+        songClock.songTime = songTime
+        startTime = time.perf_counter()
+        scheduler.playDue()
+        scheduleTimes.append(time.perf_counter() - startTime)
+
+        startTime = time.perf_counter()
+        synth.mix(songTime, 1)
+        synthTimes.append(time.perf_counter() - startTime)
+    result["updateScreen"] = timings(screenTimes)
+    # Whether the cache sizes hold what one pass through the song draws
+    result["surface_caches"] = cacheUse(cachesBefore, cacheCounts())
+    result["schedule"] = timings(scheduleTimes)
+    result["synth_block"] = timings(synthTimes)
+    result["midi_events"] = midiDevice.events
+
+    # Peak memory of loading and compiling, measured separately since tracing is slow.
+    tracemalloc.start()
+    score = bw.loadScore(path)
+    player = bw.SongPlayer()
+    player.initialize(score, players, None, bw.args.octaves, score.title, tempo)
+    result["peak_memory_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    player.close()
+
+    result["allocations"] = measureAllocations(player, songLength, frameCount)
+    return result
+
+
+def cacheCounts():
+    return {name: cache.stats() for name, cache in bw.surfaceCaches.items()}
+
+
+def cacheUse(before, after):
+    # Surface cache lookups and evictions between two cacheCounts, with the entries held after
+    use = dict()
+    for name in after:
+        use[name] = {counter: after[name][counter] - before[name][counter] for counter in ("hits", "misses", "evictions")}
+        use[name]["entries"] = after[name]["entries"]
+    return use
+
+
+def measureAllocations(player, songLength, frameCount):
+    # Render the same frames twice and measure only the second pass, so sprites
+    # and labels drawn for the first time do not count. Tracing starts with the
+    # first pass so that cache entries evicted later are seen being freed.
+    songTimes = [-bw.timeOnScreen + (songLength + bw.timeOnScreen) * frame / frameCount for frame in range(frameCount)]
+    tracemalloc.start()
+    for songTime in songTimes:
+        player.timeCode = songTime
+        player.updateScreen()
+
+    collections = []
+    def countCollection(phase, info):
+        if phase == "start":
+            collections.append(info["generation"])
+    gc.callbacks.append(countCollection)
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for songTime in songTimes:
+        player.timeCode = songTime
+        player.updateScreen()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.callbacks.remove(countCollection)
+    return {
+        "growth_kb": (current - baseline) / 1024,
+        "peak_kb": (peak - baseline) / 1024,
+        "gc_collections": len(collections),
+    }
+
+
+def measure(options):
+    bw.debugScore = False
+    bw.initDisplay()
+    bw.midiDevice = StubMidiOutput()
+    bw.openSynth()
+
+    sources = sorted(os.path.join(options.folder, f) for f in os.listdir(options.folder) if f.endswith('.musicxml'))
+    report = {"python": sys.version.split()[0], "frames": options.frames, "scores": []}
+    with tempfile.TemporaryDirectory() as scratch:
+        paths = list(sources)
+        if len(sources) > 0:
+            # Synthetic scores are built from the first song.
+            for scale in options.scales.split(','):
+                if scale.strip() != '':
+                    path = os.path.join(scratch, "x" + scale.strip() + ".musicxml")
+                    scaleScore(sources[0], path, int(scale), 1)
+                    paths.append(path)
+            if options.parts > 0:
+                path = os.path.join(scratch, "parts" + str(options.parts) + ".musicxml")
+                scaleScore(sources[0], path, 1, options.parts)
+                paths.append(path)
+        for path in paths:
+            print("Measuring", os.path.basename(path), file=sys.stderr)
+            report["scores"].append(measureScore(path, options.frames))
+    return report
+
+
+def main():
+    options = parser.parse_args()
+    with contextlib.redirect_stdout(sys.stderr):
+        report = measure(options)
+
+    failures = [score["file"] for score in report["scores"]
+        if score["allocations"]["growth_kb"] > ALLOCATION_LIMIT_KB or score["allocations"]["gc_collections"] > 0]
+
+    text = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+    if options.checkAllocations and len(failures) > 0:
+        print("Render loop allocates for", ", ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()